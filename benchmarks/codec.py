@@ -0,0 +1,85 @@
+# encoding: utf-8
+"""
+    codec
+    ~~~~~
+
+    Compares :class:`pratt.NodeCodec` with :mod:`pickle` for trees of
+    :class:`pratt.Node` instances, measuring encoding, decoding the whole
+    tree, accessing the root through a view and the size of the result.
+
+    Usage: python benchmarks/codec.py [terms]
+
+    :copyright: 2015 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+from __future__ import print_function, division
+import os
+import sys
+import timeit
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pratt import Grammar, Parser, Node, NodeCodec
+
+
+class Operation(Node):
+    __slots__ = ('operator', 'left', 'right')
+
+
+class Literal(Node):
+    __slots__ = ('token', )
+
+
+def make_grammar():
+    grammar = Grammar(lambda token: 'int' if token.isdigit() else token)
+    grammar.symbol('end')
+    grammar.literal_node('int', Literal)
+    grammar.infix_node('+', 10, Operation)
+    grammar.infix_node('*', 20, Operation)
+    return grammar
+
+
+def measure(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def main(argv):
+    terms = int(argv[1]) if len(argv) > 1 else 200
+    tokens = []
+    for i in range(terms):
+        tokens.extend([str(i % 10), '*', '2', '+'])
+    tokens[-1] = 'end'
+    tree = Parser(make_grammar(), iter(tokens)).parse()
+
+    codec = NodeCodec([Literal, Operation])
+    encoded = codec.encode(tree)
+    pickled = pickle.dumps(tree, pickle.HIGHEST_PROTOCOL)
+    number = max(1, 100000 // terms)
+    print('{0} terms, times per tree in microseconds:'.format(terms))
+    print('{0:>8} {1:>10} {2:>10} {3:>10} {4:>8}'.format(
+        '', 'encode', 'decode', 'view', 'bytes'
+    ))
+    print('{0:>8} {1:>10.1f} {2:>10.1f} {3:>10.1f} {4:>8}'.format(
+        'codec',
+        measure(lambda: codec.encode(tree), number) * 1e6,
+        measure(lambda: codec.decode(encoded), number) * 1e6,
+        measure(lambda: codec.view(encoded).operator, number) * 1e6,
+        len(encoded)
+    ))
+    print('{0:>8} {1:>10.1f} {2:>10.1f} {3:>10} {4:>8}'.format(
+        'pickle',
+        measure(lambda: pickle.dumps(tree, pickle.HIGHEST_PROTOCOL),
+                number) * 1e6,
+        measure(lambda: pickle.loads(pickled), number) * 1e6,
+        '-',
+        len(pickled)
+    ))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
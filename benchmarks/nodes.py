@@ -0,0 +1,102 @@
+# encoding: utf-8
+"""
+    nodes
+    ~~~~~
+
+    Compares the cost of creating :class:`pratt.Node` instances with that of
+    :func:`~collections.namedtuple` instances and tuples, both on their own
+    and when building trees with the node factories of :class:`pratt.Grammar`
+    instead of decorated callbacks.
+
+    Usage: python benchmarks/nodes.py [terms]
+
+    :copyright: 2015 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+from __future__ import print_function, division
+import os
+import sys
+import time
+import timeit
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pratt import Grammar, Parser, Node
+
+
+class Operation(Node):
+    __slots__ = ('operator', 'left', 'right')
+
+
+class Literal(Node):
+    __slots__ = ('token', )
+
+
+NamedOperation = namedtuple('NamedOperation', ['operator', 'left', 'right'])
+NamedLiteral = namedtuple('NamedLiteral', ['token'])
+
+
+def make_tuple(*args):
+    return args
+
+
+def make_callback_grammar(operation, literal):
+    grammar = Grammar(lambda token: token[0])
+    grammar.symbol('end')
+    grammar.literal('int')(literal)
+    grammar.infix('add', 10)(operation)
+    grammar.infix('mul', 20)(operation)
+    return grammar
+
+
+def make_node_grammar(operation, literal):
+    grammar = Grammar(lambda token: token[0])
+    grammar.symbol('end')
+    grammar.literal_node('int', literal)
+    grammar.infix_node('add', 10, operation)
+    grammar.infix_node('mul', 20, operation)
+    return grammar
+
+
+def measure_parse(grammar, tokens, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        Parser(grammar, iter(tokens)).parse()
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main(argv):
+    terms = int(argv[1]) if len(argv) > 1 else 50000
+    tokens = []
+    for i in range(terms):
+        tokens.extend([('int', str(i)), ('mul', '*'), ('int', '2')])
+        tokens.append(('add', '+'))
+    tokens[-1] = ('end', '')
+
+    print('Creating 1000000 objects:')
+    for name, factory in [
+            ('tuple', make_tuple),
+            ('namedtuple', NamedOperation),
+            ('Node', Operation)]:
+        duration = min(timeit.repeat(
+            lambda: factory('+', 1, 2), number=1000000, repeat=3
+        ))
+        print('{0:>20}: {1:.3f}s'.format(name, duration))
+
+    print('Parsing {0} terms:'.format(terms))
+    for name, grammar in [
+            ('tuple callbacks', make_callback_grammar(make_tuple, make_tuple)),
+            ('Node callbacks', make_callback_grammar(Operation, Literal)),
+            ('namedtuple factories',
+             make_node_grammar(NamedOperation, NamedLiteral)),
+            ('Node factories', make_node_grammar(Operation, Literal))]:
+        duration = measure_parse(grammar, tokens)
+        print('{0:>20}: {1:.3f}s'.format(name, duration))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
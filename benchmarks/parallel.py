@@ -0,0 +1,99 @@
+# encoding: utf-8
+"""
+    parallel
+    ~~~~~~~~
+
+    Compares :func:`pratt.parse_parallel` with :meth:`pratt.Parser.parse` for
+    a single long sum that is evaluated while it is parsed.
+
+    Besides the wall-clock time for each number of processes, the time spent
+    looking for split points in the calling process and the time it takes to
+    parse the run of a single worker are shown. The latter is the time
+    parsing should take with as many cores as processes, so it shows the
+    achievable speedup even on machines with fewer cores.
+
+    Usage: python benchmarks/parallel.py [terms] [max processes]
+
+    :copyright: 2015 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+from __future__ import print_function, division
+import os
+import sys
+import time
+import random
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import pratt
+from pratt import Grammar, Parser, parse_parallel
+
+
+def make_grammar():
+    grammar = Grammar(lambda token: 'int' if token.isdigit() else token)
+    grammar.symbol('end')
+    grammar.literal('int')(lambda token: int(token))
+    grammar.infix('+', 10)(lambda token, left, right: left + right)
+    grammar.infix('-', 10)(lambda token, left, right: left - right)
+    grammar.infix('*', 20)(lambda token, left, right: left * right)
+    grammar.enclosing('(', ')', 0)(lambda left, right, body: body)
+    return grammar
+
+
+def measure(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+def main(argv):
+    terms = int(argv[1]) if len(argv) > 1 else 200000
+    max_processes = (
+        int(argv[2]) if len(argv) > 2 else multiprocessing.cpu_count()
+    )
+    rng = random.Random(0)
+    tokens = []
+    for _ in range(terms):
+        tokens.extend([
+            str(rng.randint(1, 100)), '*', '(', str(rng.randint(1, 100)), '-',
+            str(rng.randint(1, 100)), ')', '+'
+        ])
+    tokens[-1] = 'end'
+    grammar = make_grammar()
+
+    print('{0} terms, {1} tokens, {2} CPUs'.format(
+        terms, len(tokens), multiprocessing.cpu_count()
+    ))
+    baseline, expected = measure(lambda: Parser(grammar, iter(tokens)).parse())
+    print('{0:>12}: {1:.3f}s'.format('sequential', baseline))
+    processes = 2
+    while processes <= max(max_processes, 2):
+        duration, result = measure(
+            lambda: parse_parallel(grammar, tokens, processes)
+        )
+        assert result == expected
+        split_duration, (type, split_points) = measure(
+            lambda: pratt._find_split_points(grammar, tokens, processes)
+        )
+        run_duration, _ = measure(
+            lambda: Parser(
+                grammar, iter(tokens[:split_points[0]] + ['end'])
+            ).parse()
+        )
+        print(
+            '{0:>2} processes: {1:.3f}s ({2:.2f}x), split points found in '
+            '{3:.4f}s, one run parsed in {4:.3f}s ({5:.2f}x)'.format(
+                processes, duration, baseline / duration, split_duration,
+                run_duration, baseline / run_duration
+            )
+        )
+        processes *= 2
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,72 @@
+# encoding: utf-8
+"""
+    threads
+    ~~~~~~~
+
+    Measures how the throughput of :func:`pratt.parse_concurrently` scales
+    with the number of threads, using the grammar of `examples/math_expr.py`.
+
+    On builds with the GIL, throughput is not expected to improve with more
+    threads. On free-threaded builds it should scale roughly linearly up to
+    the number of available cores, as parsers share no mutable state.
+
+    Usage: python benchmarks/threads.py [expressions] [max threads]
+
+    :copyright: 2015 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+from __future__ import print_function, division
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'examples'))
+
+from pratt import parse_concurrently
+import math_expr
+
+
+def generate_expression(rng, terms):
+    return ' + '.join(
+        '({0} * {1} - {2})'.format(
+            rng.randint(1, 100), rng.randint(1, 100), rng.randint(1, 100)
+        )
+        for _ in range(terms)
+    )
+
+
+def measure(grammar, tokens, threads):
+    start = time.time()
+    parse_concurrently(grammar, (iter(t) for t in tokens), threads)
+    return len(tokens) / (time.time() - start)
+
+
+def main(argv):
+    expressions = int(argv[1]) if len(argv) > 1 else 2000
+    max_threads = int(argv[2]) if len(argv) > 2 else os.cpu_count() or 1
+    rng = random.Random(0)
+    # Tokenize up front, so that only parsing is measured.
+    tokens = [
+        list(math_expr.tokenize(generate_expression(rng, 20)))
+        for _ in range(expressions)
+    ]
+    grammar = math_expr.grammar.extend().freeze()
+
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)
+    print('GIL enabled: {0}'.format(is_gil_enabled()))
+    baseline = None
+    threads = 1
+    while threads <= max_threads:
+        throughput = measure(grammar, tokens, threads)
+        baseline = baseline or throughput
+        print('{0:>3} threads: {1:>10.0f} expressions/s ({2:.2f}x)'.format(
+            threads, throughput, throughput / baseline
+        ))
+        threads *= 2
+
+
+if __name__ == '__main__':
+    main(sys.argv)
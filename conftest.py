@@ -0,0 +1,15 @@
+# encoding: utf-8
+"""
+    conftest
+    ~~~~~~~~
+
+    :copyright: 2015 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import sys
+
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # Uses async def, which is a syntax error on earlier versions.
+    collect_ignore.append('test_math_server.py')
@@ -9,13 +9,24 @@
     :copyright: 2015 by Daniel Neuhäuser
     :license: BSD, see LICENSE.rst for details
 """
-from __future__ import print_function
+from __future__ import print_function, division
 import re
 import sys
+import mmap
+import time
+import argparse
+import collections
+import multiprocessing
+import operator
 from operator import itemgetter
 
 from pratt import Grammar, Parser
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 token_re = re.compile(r"""
     (?P<int>\d+)|
@@ -25,6 +36,8 @@ token_re = re.compile(r"""
     (?P<div>/)|
     (?P<left_paren>\()|
     (?P<right_paren>\))|
+    (?P<question>\?)|
+    (?P<colon>:)|
     (?P<whitespace>\s+)
 """, re.VERBOSE)
 
@@ -34,7 +47,7 @@ def tokenize(string):
     This returns an iterator yielding tuples consisting of a type and a lexeme.
 
     Possible types are `int`, `add`, `sub`, `mul`, `div`, `left_paren`,
-    `right_paren` and `end`. Lexemes are always strings.
+    `right_paren`, `question`, `colon` and `end`. Lexemes are always strings.
     """
     for match in token_re.finditer(string):
         for type, lexeme in match.groupdict().items():
@@ -45,6 +58,73 @@ def tokenize(string):
     yield 'end', ''
 
 
+#: The token types produced by :func:`tokenize_bulk`, the arrays returned by
+#: it contain indices into this list.
+bulk_types = [
+    'whitespace', 'int', 'add', 'sub', 'mul', 'div', 'left_paren',
+    'right_paren', 'question', 'colon', 'newline', 'unknown'
+]
+
+WHITESPACE = bulk_types.index('whitespace')
+INT = bulk_types.index('int')
+NEWLINE = bulk_types.index('newline')
+UNKNOWN = bulk_types.index('unknown')
+
+
+def _make_character_classes():
+    classes = numpy.full(256, UNKNOWN, dtype=numpy.uint8)
+    for character in bytearray(b' \t\r\f\v'):
+        classes[character] = WHITESPACE
+    for character in bytearray(b'0123456789'):
+        classes[character] = INT
+    for type, character in zip(bulk_types[2:10], bytearray(b'+-*/()?:')):
+        classes[character] = bulk_types.index(type)
+    classes[ord('\n')] = NEWLINE
+    return classes
+
+
+if numpy is not None:
+    _character_classes = _make_character_classes()
+
+
+def tokenize_bulk(data):
+    """
+    Tokenizes an ASCII encoded buffer such as a byte string or memory map at
+    once and returns three NumPy arrays: the types of the tokens, as indices
+    into :data:`bulk_types`, and the offsets at which each token starts and
+    ends.
+
+    Unlike :func:`tokenize`, newlines are tokens of the type `newline`,
+    characters that are not part of any token are tokens of the type
+    `unknown` and no `end` token is added.
+
+    Requires NumPy.
+    """
+    if numpy is None:
+        raise RuntimeError('tokenize_bulk requires NumPy')
+    classes = _character_classes[numpy.frombuffer(data, dtype=numpy.uint8)]
+    is_token = classes != WHITESPACE
+    is_int = classes == INT
+    # Consecutive digits form a single token, every other character except
+    # whitespace is a token on its own.
+    continues_previous = numpy.zeros_like(is_int)
+    continues_previous[1:] = is_int[1:] & is_int[:-1]
+    continued = numpy.zeros_like(is_int)
+    continued[:-1] = continues_previous[1:]
+    starts = numpy.flatnonzero(is_token & ~continues_previous)
+    ends = numpy.flatnonzero(is_token & ~continued) + 1
+    return classes[starts], starts, ends
+
+
+def _bulk_tokens(data, types, starts, ends, begin, end):
+    for index in range(begin, end):
+        yield (
+            bulk_types[types[index]],
+            data[starts[index]:ends[index]].decode('latin-1')
+        )
+    yield 'end', ''
+
+
 class SyntaxError(Exception):
     pass
 
@@ -127,10 +207,21 @@ def parenthesis(left_paren, right_paren, body):
     return body
 
 
+@grammar.ternary('question', 'colon', 5, lazy=True)
+def conditional(question, colon, condition, then, orelse):
+    # As we evaluate while parsing, `then` and `orelse` are deferred, so that
+    # only the operand we actually need is parsed and evaluated. This way
+    # 0 ? 1 / 0 : 1 doesn't raise a ZeroDivisionError.
+    if condition:
+        return then()
+    return orelse()
+
+
 def evaluate(string):
     """
     Evaluates a mathematical expressions. Available operators are `+`, `-`, `*`
-    and `/`. Parenthesis are supported. The only available numbers are
+    and `/` as well as the conditional operator `?:`. Parenthesis are
+    supported. The only available numbers are
     integers. Whitespace is ignored.
     """
     tokenizer = tokenize(string)
@@ -138,7 +229,229 @@ def evaluate(string):
     return parser.parse()
 
 
+def compile_expression(string):
+    """
+    Compiles a mathematical expression into a :class:`pratt.Program`, which
+    can be stored and evaluated later with :func:`evaluate_program`.
+    """
+    tokenizer = tokenize(string)
+    parser = Parser(grammar, tokenizer)
+    return parser.compile()
+
+
+#: Maps the operations of compiled expressions to the functions implementing
+#: them.
+operations = {
+    ('prefix', 'add'): operator.pos,
+    ('prefix', 'sub'): operator.neg,
+    ('infix', 'add'): operator.add,
+    ('infix', 'sub'): operator.sub,
+    ('infix', 'mul'): operator.mul,
+    ('infix', 'div'): operator.floordiv,
+    ('ternary', 'question'): lambda condition, then, orelse: (
+        then if condition else orelse
+    ),
+}
+
+
+def evaluate_program(program):
+    """
+    Evaluates a program returned by :func:`compile_expression`.
+
+    Programs are evaluated by a stack machine without recursion. Unlike
+    :func:`evaluate`, both operands of the conditional operator are
+    evaluated, as the stack machine has no way to skip instructions.
+    """
+    return program.run(operations)
+
+
+def evaluate_lines(lines):
+    """
+    Evaluates each of the given lines, which are expected to be ASCII encoded
+    byte strings, and returns a list of `(result, error)` tuples.
+
+    If evaluating a line fails, `result` is `None` and `error` a string
+    describing the problem, otherwise `error` is `None`.
+    """
+    return [
+        _capture_errors(lambda: evaluate(line.decode('ascii')))
+        for line in lines
+    ]
+
+
+def evaluate_buffer(data):
+    """
+    Evaluates each line in an ASCII encoded buffer, using
+    :func:`tokenize_bulk`, and returns a list of `(result, error)` tuples
+    like :func:`evaluate_lines` does for ``data.split(b'\\n')``.
+
+    Characters that are not part of any token cause an error, instead of
+    being ignored as by :func:`tokenize`.
+
+    Requires NumPy.
+    """
+    types, starts, ends = tokenize_bulk(data)
+    newlines = numpy.flatnonzero(types == NEWLINE).tolist()
+    types, starts, ends = types.tolist(), starts.tolist(), ends.tolist()
+    results = []
+    begin = 0
+    for end in newlines + [len(types)]:
+        tokens = _bulk_tokens(data, types, starts, ends, begin, end)
+        results.append(
+            _capture_errors(lambda: Parser(grammar, tokens).parse())
+        )
+        begin = end + 1
+    return results
+
+
+def _capture_errors(function):
+    try:
+        return function(), None
+    except (SyntaxError, ArithmeticError, ValueError) as error:
+        return None, '{}: {}'.format(type(error).__name__, error)
+    except StopIteration:
+        # The parser ran past the end token, because the expression is
+        # incomplete.
+        return None, 'SyntaxError: unexpected end'
+
+
+def read_chunks(path, chunk_size, split=True):
+    """
+    Memory maps the file at `path` and yields lists of the lines in it, each
+    list covering about `chunk_size` bytes.
+
+    If `split` is false, the lines are yielded as a single byte string
+    instead of a list.
+    """
+    with open(path, 'rb') as f:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            return
+        try:
+            start = 0
+            while start < len(mapping):
+                end = mapping.find(b'\n', start + chunk_size)
+                if end == -1:
+                    end = len(mapping)
+                    # The final newline ends the last line, it doesn't
+                    # start another one.
+                    if mapping[end - 1:end] == b'\n':
+                        end -= 1
+                chunk = mapping[start:end]
+                yield chunk.split(b'\n') if split else chunk
+                start = end + 1
+        finally:
+            mapping.close()
+
+
+def _write_results(results, output):
+    # Writes the results of evaluating a chunk and returns the number of
+    # errors among them.
+    errors = 0
+    for result, error in results:
+        if error is None:
+            output.write('{}\n'.format(result))
+        else:
+            output.write('error: {}\n'.format(error))
+            errors += 1
+    return errors
+
+
+def evaluate_file(path, output, processes=None, chunk_size=1 << 20,
+                  bulk=False):
+    """
+    Evaluates every line in the file at `path` with a pool of `processes`
+    and writes the results in order to the `output` file object, as soon
+    as they are available.
+
+    If `bulk` is true, :func:`evaluate_buffer` is used for tokenizing.
+
+    At most two chunks per process are read ahead of the results written,
+    so that memory use doesn't depend on the size of the file.
+
+    Returns a tuple with the number of expressions and errors.
+    """
+    expressions = errors = 0
+    function = evaluate_buffer if bulk else evaluate_lines
+    chunks = read_chunks(path, chunk_size, split=not bulk)
+    max_pending = 2 * (processes or multiprocessing.cpu_count())
+    pending = collections.deque()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(function, (chunk, )))
+            while pending and (
+                    len(pending) >= max_pending or pending[0].ready()):
+                results = pending.popleft().get()
+                expressions += len(results)
+                errors += _write_results(results, output)
+        while pending:
+            results = pending.popleft().get()
+            expressions += len(results)
+            errors += _write_results(results, output)
+    finally:
+        chunks.close()
+        pool.terminate()
+    return expressions, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Evaluates mathematical expressions.'
+    )
+    parser.add_argument('expression', nargs='*')
+    parser.add_argument(
+        '-f', '--file',
+        help='evaluate each line of the given file instead'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='write results of --file to the given file instead of stdout'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='number of processes used for --file, defaults to the number '
+             'of CPUs'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=1 << 20,
+        help='approximate number of bytes per chunk of work for --file'
+    )
+    parser.add_argument(
+        '--bulk', action='store_true',
+        help='tokenize each chunk of --file at once, requires NumPy'
+    )
+    arguments = parser.parse_args(argv)
+
+    if arguments.file is None:
+        expression = ' '.join(arguments.expression)
+        print('> {}'.format(expression))
+        print(evaluate(expression))
+        return 0
+
+    output = sys.stdout
+    if arguments.output is not None:
+        output = open(arguments.output, 'w')
+    try:
+        start = time.time()
+        expressions, errors = evaluate_file(
+            arguments.file, output, arguments.jobs, arguments.chunk_size,
+            arguments.bulk
+        )
+        duration = time.time() - start
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(
+        '{} expressions, {} errors in {:.2f}s ({:.0f} expressions/s)'.format(
+            expressions, errors, duration, expressions / max(duration, 1e-9)
+        ),
+        file=sys.stderr
+    )
+    return 1 if errors else 0
+
+
 if __name__ == '__main__':
-    expression = ' '.join(sys.argv[1:])
-    print('> {}'.format(expression))
-    print(evaluate(expression))
+    sys.exit(main())
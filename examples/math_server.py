@@ -0,0 +1,354 @@
+# encoding: utf-8
+"""
+    math_server
+    ~~~~~~~~~~~
+
+    This is an example for a service that evaluates mathematical expressions,
+    using the parser from `math_expr.py`, for clients connecting to a local
+    socket.
+
+    Clients send one expression per line and receive one result per line, in
+    the same order. Lines with errors are answered with ``error: ...``.
+
+    Requests of all clients are collected into small batches, which are
+    evaluated in an executor, so that the event loop isn't blocked by
+    evaluation. Identical expressions within a batch are only evaluated once.
+
+    Start the server with ``python math_server.py serve`` or measure its
+    throughput with ``python math_server.py benchmark``.
+
+    Requires Python 3.7 or later.
+
+    :copyright: 2015 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import math_expr
+
+
+class EvaluationError(Exception):
+    """
+    Raised when an expression cannot be evaluated.
+    """
+
+
+def evaluate_batch(expressions):
+    """
+    Evaluates a list of expressions and returns a list of `(result, error)`
+    tuples, see :func:`math_expr.evaluate_lines`.
+    """
+    return math_expr.evaluate_lines(
+        [expression.encode('utf-8') for expression in expressions]
+    )
+
+
+class BatchEvaluator(object):
+    """
+    Evaluates expressions in batches of at most `max_batch_size`
+    expressions, using the given `executor`.
+
+    A batch is dispatched, once it is full or `max_delay` seconds after its
+    first expression has been received. At most `max_pending` expressions
+    are queued and at most `max_batches` batches are evaluated at the same
+    time. When these limits are reached, :meth:`evaluate` waits, which
+    applies backpressure to the callers.
+    """
+
+    def __init__(self, executor, max_batch_size=64, max_delay=0.002,
+                 max_pending=4096, max_batches=8):
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_batches = max_batches
+
+        self.requests = 0
+        self.evaluated = 0
+        self.errors = 0
+        self.batches = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.started = None
+
+        self._queue = None
+        self._batch_slots = None
+        self._task = None
+        self._batch_tasks = set()
+
+    def start(self):
+        """
+        Starts collecting batches, must be called within the event loop.
+        """
+        self._queue = asyncio.Queue(self.max_pending)
+        self._batch_slots = asyncio.Semaphore(self.max_batches)
+        self._task = asyncio.ensure_future(self._collect_batches())
+        self.started = time.monotonic()
+
+    async def close(self):
+        """
+        Stops collecting batches and waits for dispatched batches.
+        """
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        if self._batch_tasks:
+            await asyncio.wait(self._batch_tasks)
+
+    async def evaluate(self, expression):
+        """
+        Returns the result of evaluating `expression` or raises an
+        :exc:`EvaluationError`.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((expression, future, time.monotonic()))
+        return await future
+
+    async def _collect_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(
+                            self._queue.get(), timeout
+                        )
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self._queue.get_nowait()
+                batch.append(request)
+            await self._batch_slots.acquire()
+            task = asyncio.ensure_future(self._evaluate_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _evaluate_batch(self, batch):
+        try:
+            # Preserves the order of the first occurrences, which makes
+            # batches deterministic.
+            expressions = list(dict.fromkeys(
+                expression for expression, _, _ in batch
+            ))
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, evaluate_batch, expressions
+                )
+            except Exception as error:
+                results = [(None, repr(error))] * len(expressions)
+        finally:
+            self._batch_slots.release()
+        results = dict(zip(expressions, results))
+
+        self.batches += 1
+        self.evaluated += len(expressions)
+        now = time.monotonic()
+        for expression, future, received in batch:
+            self.requests += 1
+            latency = now - received
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if future.cancelled():
+                continue
+            result, error = results[expression]
+            if error is None:
+                future.set_result(result)
+            else:
+                self.errors += 1
+                future.set_exception(EvaluationError(error))
+
+    def statistics(self):
+        """
+        Returns a dictionary with counters and latency statistics.
+        """
+        duration = time.monotonic() - self.started if self.started else 0.0
+        return {
+            'requests': self.requests,
+            'evaluated': self.evaluated,
+            'errors': self.errors,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / max(self.batches, 1),
+            'mean_latency': self.total_latency / max(self.requests, 1),
+            'max_latency': self.max_latency,
+            'throughput': self.requests / duration if duration else 0.0,
+        }
+
+
+class Server(object):
+    """
+    Serves evaluation of expressions for clients connecting to `host` and
+    `port`, using a :class:`BatchEvaluator`.
+
+    Each client may have up to `max_pipeline` expressions in flight.
+    """
+
+    def __init__(self, evaluator, max_pipeline=256):
+        self.evaluator = evaluator
+        self.max_pipeline = max_pipeline
+        self._server = None
+        self._clients = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.evaluator.start()
+        self._server = await asyncio.start_server(
+            self._handle_client, host, port
+        )
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        """
+        Stops accepting clients and waits for connected clients to
+        disconnect.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        if self._clients:
+            await asyncio.wait(self._clients)
+        await self.evaluator.close()
+
+    async def _handle_client(self, reader, writer):
+        client = asyncio.ensure_future(self._serve_client(reader, writer))
+        self._clients.add(client)
+        client.add_done_callback(self._clients.discard)
+        await client
+
+    async def _serve_client(self, reader, writer):
+        pending = asyncio.Queue(self.max_pipeline)
+        responder = asyncio.ensure_future(self._respond(pending, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                expression = line.decode('utf-8', 'replace').strip()
+                await pending.put(asyncio.ensure_future(
+                    self.evaluator.evaluate(expression)
+                ))
+            await pending.put(None)
+            await responder
+        finally:
+            responder.cancel()
+            writer.close()
+
+    async def _respond(self, pending, writer):
+        while True:
+            future = await pending.get()
+            if future is None:
+                break
+            try:
+                response = str(await future)
+            except EvaluationError as error:
+                response = 'error: {}'.format(error)
+            writer.write(response.encode('utf-8') + b'\n')
+            await writer.drain()
+
+
+async def generate_load(host, port, connections, requests, expressions):
+    """
+    Opens `connections` connections to the server at `host` and `port`, and
+    sends `requests` expressions, randomly chosen from `expressions`, over
+    each of them. Returns the responses for each connection.
+    """
+    async def client(seed):
+        rng = random.Random(seed)
+        reader, writer = await asyncio.open_connection(host, port)
+        sent = [rng.choice(expressions) for _ in range(requests)]
+
+        async def send():
+            for expression in sent:
+                writer.write(expression.encode('utf-8') + b'\n')
+                await writer.drain()
+
+        sender = asyncio.ensure_future(send())
+        responses = []
+        for _ in sent:
+            line = await reader.readline()
+            responses.append(line.decode('utf-8').rstrip('\n'))
+        await sender
+        writer.close()
+        await writer.wait_closed()
+        return responses
+
+    return await asyncio.gather(*[client(i) for i in range(connections)])
+
+
+async def benchmark(connections, requests, distinct, executor):
+    rng = random.Random(0)
+    expressions = [
+        '{} * ({} + {}) - {}'.format(*[rng.randint(1, 100) for _ in range(4)])
+        for _ in range(distinct)
+    ]
+    server = Server(BatchEvaluator(executor))
+    host, port = await server.start()
+    start = time.monotonic()
+    await generate_load(host, port, connections, requests, expressions)
+    duration = time.monotonic() - start
+    statistics = server.evaluator.statistics()
+    await server.close()
+    print('{} requests in {:.2f}s ({:.0f} requests/s)'.format(
+        connections * requests, duration, connections * requests / duration
+    ))
+    for name, value in sorted(statistics.items()):
+        print('{:>16}: {:.4g}'.format(name, value))
+
+
+async def serve(host, port, executor):
+    server = Server(BatchEvaluator(executor))
+    host, port = await server.start(host, port)
+    print('listening on {}:{}'.format(host, port))
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(server.evaluator.statistics())
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serves evaluation of mathematical expressions.'
+    )
+    parser.add_argument('--workers', type=int, default=None)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    benchmark_parser = commands.add_parser('benchmark')
+    benchmark_parser.add_argument('--connections', type=int, default=32)
+    benchmark_parser.add_argument('--requests', type=int, default=1000)
+    benchmark_parser.add_argument('--distinct', type=int, default=500)
+    arguments = parser.parse_args(argv)
+
+    # Workers are started lazily, forking them would let them inherit the
+    # sockets of connected clients, which keeps those connections open.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(arguments.workers, context) as executor:
+        if arguments.command == 'benchmark':
+            asyncio.run(benchmark(
+                arguments.connections, arguments.requests,
+                arguments.distinct, executor
+            ))
+        else:
+            try:
+                asyncio.run(serve(arguments.host, arguments.port, executor))
+            except KeyboardInterrupt:
+                pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
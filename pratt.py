@@ -6,6 +6,16 @@
     :copyright: 2015 by Daniel Neuhäuser
     :license: BSD, see LICENSE.rst for details
 """
+import sys
+import time
+import types
+import struct
+import operator
+import itertools
+import threading
+import hashlib
+from array import array
+from bisect import bisect_right
 
 
 #: The library version as a string.
@@ -15,6 +25,14 @@ __version__ = '0.2.0'
 __version_info__ = (0, 2, 0)
 
 
+_INFINITY = float('inf')
+
+#: Number of tokens after which the timeout of a parser is checked.
+_TIMEOUT_INTERVAL = 256
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
 class PrattException(Exception):
     """
     Base class for exceptions raised by Pratt.
@@ -33,6 +51,130 @@ class UnexpectedToken(PrattException):
         self.token = token
 
 
+class LimitExceeded(PrattException):
+    """
+    Raised when a :class:`Parser` exceeds one of the limits it was configured
+    with.
+    """
+    def __init__(self, limit, value):
+        super(LimitExceeded, self).__init__(
+            '{0} of {1} exceeded'.format(limit, value)
+        )
+        #: The name of the exceeded limit, one of ``'max_tokens'``,
+        #: ``'max_depth'`` or ``'timeout'``.
+        self.limit = limit
+        #: The value the limit was configured with.
+        self.value = value
+
+
+def _get_node_fields(node_type):
+    # Returns the names of the slots of a Node subclass, including those of
+    # its bases, in the order in which they are defined. They are cached in
+    # the class itself.
+    try:
+        return node_type.__dict__['_node_fields']
+    except KeyError:
+        pass
+    fields = []
+    for base in reversed(node_type.__mro__):
+        slots = base.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots, )
+        fields.extend(
+            slot for slot in slots if slot not in ('__dict__', '__weakref__')
+        )
+    node_type._node_fields = fields = tuple(fields)
+    return fields
+
+
+def _make_node_init(node_type):
+    # Returns an __init__ for a Node subclass, that assigns its arguments to
+    # the fields directly, which is much faster than a generic one.
+    fields = _get_node_fields(node_type)
+    self = 'self'
+    while self in fields:
+        self += '_'
+    lines = ['def __init__({0}):'.format(', '.join((self, ) + fields))]
+    lines.extend('    {0}.{1} = {1}'.format(self, name) for name in fields)
+    lines.append('    pass')
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    init = namespace['__init__']
+    init._node_init = True
+    return init
+
+
+class _NodeType(type):
+    # Gives every Node subclass a generated __init__, unless it or one of
+    # its bases defines its own.
+    def __init__(cls, name, bases, namespace):
+        super(_NodeType, cls).__init__(name, bases, namespace)
+        for base in cls.__mro__:
+            if '__init__' in base.__dict__:
+                init = base.__dict__['__init__']
+                if base is not cls and getattr(init, '_node_init', False):
+                    cls.__init__ = _make_node_init(cls)
+                break
+
+
+class Node(_NodeType('_NodeBase', (object, ), {'__slots__': ()})):
+    """
+    Base class for compact nodes, as created by the node factories of
+    :class:`Grammar` such as :meth:`Grammar.infix_node`.
+
+    Subclasses define their fields with `__slots__`, the constructor assigns
+    the positional arguments it's called with to them in order::
+
+        class BinaryOperation(pratt.Node):
+            __slots__ = ('operator', 'left', 'right')
+
+    Fields defined by base classes come first. The constructor is generated
+    for every subclass, which makes creating nodes about as fast as creating
+    :func:`~collections.namedtuple` instances.
+    """
+    __slots__ = ()
+
+    def __init__(self):
+        pass
+
+    __init__._node_init = True
+
+    def __eq__(self, other):
+        if self.__class__ is not other.__class__:
+            return NotImplemented
+        # Nested nodes are compared without recursion, so that even deep
+        # trees can be compared.
+        stack = [(self, other)]
+        while stack:
+            node, other = stack.pop()
+            for name in _get_node_fields(node.__class__):
+                value = getattr(node, name)
+                other_value = getattr(other, name)
+                if (isinstance(value, Node) and
+                        value.__class__ is other_value.__class__):
+                    stack.append((value, other_value))
+                elif value != other_value:
+                    return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0}({1})'.format(
+            self.__class__.__name__,
+            ', '.join(
+                repr(getattr(self, name))
+                for name in _get_node_fields(self.__class__)
+            )
+        )
+
+
 def handle_unexpected_token(token):
     """
     Default unexpected token handler that raises :exc:`UnexpectedToken`.
@@ -40,6 +182,82 @@ def handle_unexpected_token(token):
     raise UnexpectedToken(token)
 
 
+_DEFINITION_FIELDS = frozenset([
+    'left_binding_power', 'null_denotation', 'left_denotation'
+])
+
+
+def _update_fingerprint(hash, obj, seen):
+    def update(string):
+        hash.update(string.encode('utf-8'))
+        hash.update(b'\0')
+
+    if isinstance(obj, (type(None), bool, int, float, str, bytes, type(u''))):
+        update(repr(obj))
+    elif isinstance(obj, (tuple, list, frozenset)):
+        update(obj.__class__.__name__)
+        if isinstance(obj, frozenset):
+            obj = sorted(obj, key=repr)
+        for item in obj:
+            _update_fingerprint(hash, item, seen)
+        update('end')
+    elif isinstance(obj, dict):
+        update('dict')
+        for key in sorted(obj, key=repr):
+            _update_fingerprint(hash, key, seen)
+            _update_fingerprint(hash, obj[key], seen)
+        update('end')
+    elif isinstance(obj, types.CodeType):
+        update(repr(obj.co_code))
+        update(repr(obj.co_names))
+        for const in obj.co_consts:
+            _update_fingerprint(hash, const, seen)
+    elif isinstance(obj, types.FunctionType):
+        update(obj.__module__)
+        update(getattr(obj, '__qualname__', obj.__name__))
+        # Functions may refer to themselves through their closure.
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        _update_fingerprint(hash, obj.__code__, seen)
+        _update_fingerprint(hash, obj.__defaults__, seen)
+        for cell in obj.__closure__ or ():
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                update('empty cell')
+            else:
+                _update_fingerprint(hash, contents, seen)
+    elif isinstance(obj, Grammar):
+        # Denotations may refer to their grammar, whose definitions are
+        # covered by the fingerprint anyway, while the rest of its state,
+        # such as whether it's frozen, must not affect it.
+        update('grammar')
+    elif isinstance(obj, type) or hasattr(obj, '__name__'):
+        # Classes and builtin functions are identified by their name.
+        update(getattr(obj, '__module__', None) or '')
+        update(getattr(obj, '__qualname__', getattr(obj, '__name__', '')))
+    else:
+        # Other objects, such as operator.itemgetter(0), are identified by
+        # their class and the values they would be pickled with.
+        _update_fingerprint(hash, obj.__class__, seen)
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        try:
+            reduced = obj.__reduce_ex__(2)
+        except Exception:
+            reduced = None
+        if isinstance(reduced, tuple):
+            for part in reduced[1:3]:
+                _update_fingerprint(hash, part, seen)
+            for items in reduced[3:5]:
+                if items is not None:
+                    _update_fingerprint(hash, list(items), seen)
+        elif ' at 0x' not in repr(obj):
+            update(repr(obj))
+
+
 class Grammar(object):
     """
     Grammar objects define the `left_binding_power`, `null_denotation`,
@@ -53,6 +271,10 @@ class Grammar(object):
         A function that gets called when an unexpected token is encountered,
         must raise an exception. The default implementation raises an
         :exc:`UnexpectedToken` error.
+
+    Once a grammar is :meth:`frozen <freeze>`, it can no longer be changed
+    and can safely be shared between any number of parsers running in
+    different threads. Parsers never change the grammar they use.
     """
 
     def __init__(self, get_token_type,
@@ -60,6 +282,15 @@ class Grammar(object):
         self.get_token_type = get_token_type
         self.handle_unexpected_token = handle_unexpected_token
         self._definitions = {}
+        # Maps the types of definitions inherited from the grammar this one
+        # was extended from, to the names of the fields that have not been
+        # redefined yet.
+        self._inherited = {}
+        # Maps (type, 'null_denotation' or 'left_denotation') to a tuple
+        # describing the shape of denotations defined with decorators such
+        # as infix, which allows analyzing token sequences without parsing.
+        self._shapes = {}
+        self._frozen = False
 
     def _create_definition(self, type, left_binding_power=0,
                            null_denotation=None, left_denotation=None):
@@ -71,25 +302,58 @@ class Grammar(object):
 
     def _update_definition(self, type, left_binding_power=0,
                            null_denotation=None, left_denotation=None):
-        definition = self._definitions[type]
-        definition['left_binding_power'] = max([
-            definition['left_binding_power'],
-            left_binding_power
-        ])
+        # Definitions may be shared with grammars extending this one, so they
+        # are never changed in place but replaced with an updated copy.
+        definition = dict(self._definitions[type])
+        inherited = self._inherited.get(type, frozenset())
+        redefining = set()
+        if null_denotation is not None:
+            redefining.add('null_denotation')
+        if left_denotation is not None:
+            redefining.add('left_denotation')
+        # The inherited binding power is only replaced, if no inherited
+        # denotation, that may depend on it, remains.
+        still_inherited = [
+            name for name in inherited - redefining
+            if name != 'left_binding_power' and definition[name] is not None
+        ]
+        if (redefining and 'left_binding_power' in inherited and
+                not still_inherited):
+            definition['left_binding_power'] = left_binding_power
+            inherited = inherited - {'left_binding_power'}
+        else:
+            if redefining:
+                # The binding power combines inherited and new values now.
+                inherited = inherited - {'left_binding_power'}
+            definition['left_binding_power'] = max([
+                definition['left_binding_power'],
+                left_binding_power
+            ])
         if null_denotation is not None:
-            if definition['null_denotation'] is None:
+            if (definition['null_denotation'] is None or
+                    'null_denotation' in inherited):
                 definition['null_denotation'] = null_denotation
+                inherited = inherited - {'null_denotation'}
             else:
                 raise RuntimeError('null_denotation already defined')
         if left_denotation is not None:
-            if definition['left_denotation'] is None:
+            if (definition['left_denotation'] is None or
+                    'left_denotation' in inherited):
                 definition['left_denotation'] = left_denotation
+                inherited = inherited - {'left_denotation'}
             else:
                 raise RuntimeError('left_denotation already defined')
+        if inherited:
+            self._inherited[type] = inherited
+        else:
+            self._inherited.pop(type, None)
+        self._definitions[type] = definition
 
     def _create_or_update_definition(self, type, left_binding_power=0,
                                      null_denotation=None,
                                      left_denotation=None):
+        if self._frozen:
+            raise RuntimeError('grammar is frozen')
         if type in self._definitions:
             self._update_definition(
                 type, left_binding_power, null_denotation, left_denotation
@@ -98,6 +362,90 @@ class Grammar(object):
             self._create_definition(
                 type, left_binding_power, null_denotation, left_denotation
             )
+        # Shapes are only discarded once the definition has been replaced,
+        # so that a failed redefinition leaves the existing one intact.
+        if null_denotation is not None:
+            self._shapes.pop((type, 'null_denotation'), None)
+        if left_denotation is not None:
+            self._shapes.pop((type, 'left_denotation'), None)
+
+    @property
+    def frozen(self):
+        """
+        `True` if the grammar has been frozen with :meth:`freeze`.
+        """
+        return self._frozen
+
+    def freeze(self):
+        """
+        Freezes the grammar and returns it.
+
+        Defining tokens in a frozen grammar raises a :exc:`RuntimeError`.
+        A frozen grammar can still be :meth:`extended <extend>`, the
+        resulting grammar is not frozen.
+        """
+        self._frozen = True
+        return self
+
+    def fingerprint(self):
+        """
+        Returns a string that identifies the definitions of this grammar.
+
+        The fingerprint is derived from the binding powers and the functions
+        that are part of the grammar, including their code and the values
+        they close over, so it remains the same across interpreter restarts,
+        as long as the grammar doesn't change. It does not cover globals the
+        functions refer to. Other callable objects are identified by their
+        class and the values they are pickled with, objects that can't be
+        pickled, such as :func:`operator.itemgetter` objects on Python 2,
+        only by their class.
+
+        The fingerprint of a frozen grammar is only computed once.
+        """
+        fingerprint = getattr(self, '_fingerprint', None)
+        if fingerprint is not None:
+            return fingerprint
+        hash = hashlib.sha1()
+        seen = set()
+        _update_fingerprint(hash, self.get_token_type, seen)
+        _update_fingerprint(hash, self.handle_unexpected_token, seen)
+        for type, definition in sorted(
+                self._definitions.items(), key=lambda item: repr(item[0])):
+            _update_fingerprint(hash, type, seen)
+            _update_fingerprint(hash, definition['left_binding_power'], seen)
+            _update_fingerprint(hash, definition['null_denotation'], seen)
+            _update_fingerprint(hash, definition['left_denotation'], seen)
+        fingerprint = hash.hexdigest()
+        if self._frozen:
+            self._fingerprint = fingerprint
+        return fingerprint
+
+    def extend(self, get_token_type=None, handle_unexpected_token=None):
+        """
+        Returns a new grammar that inherits all definitions of this grammar.
+
+        The definitions are shared between both grammars instead of being
+        copied, so extending even large grammars is cheap and the derived
+        grammar is as fast as one that defines everything itself.
+
+        Tokens can be added to the derived grammar as usual. Inherited
+        denotations may be redefined, which replaces them along with the
+        `left_binding_power`, without affecting this grammar. Definitions
+        added to this grammar afterwards are not inherited.
+
+        `get_token_type` and `handle_unexpected_token` default to the ones
+        of this grammar.
+        """
+        grammar = self.__class__(
+            get_token_type or self.get_token_type,
+            handle_unexpected_token or self.handle_unexpected_token
+        )
+        grammar._definitions = dict(self._definitions)
+        grammar._inherited = dict.fromkeys(
+            self._definitions, _DEFINITION_FIELDS
+        )
+        grammar._shapes = dict(self._shapes)
+        return grammar
 
     def symbol(self, type):
         """
@@ -165,6 +513,7 @@ class Grammar(object):
             @self.null_denotation(type)
             def null_denotation(token, parser):
                 return function(token)
+            self._shapes[type, 'null_denotation'] = ('literal', function)
             return function
         return decorate
 
@@ -180,6 +529,9 @@ class Grammar(object):
             def null_denotation(token, parser):
                 operand = parser.parse(right_binding_power=binding_power)
                 return function(token, operand)
+            self._shapes[type, 'null_denotation'] = (
+                'prefix', binding_power, function
+            )
             return function
         return decorate
 
@@ -195,6 +547,9 @@ class Grammar(object):
             def left_denotation(token, parser, left):
                 right = parser.parse(right_binding_power=binding_power)
                 return function(token, left, right)
+            self._shapes[type, 'left_denotation'] = (
+                'infix', binding_power, function
+            )
             return function
         return decorate
 
@@ -210,6 +565,47 @@ class Grammar(object):
             def left_denotation(token, parser, left):
                 right = parser.parse(right_binding_power=binding_power - 1)
                 return function(token, left, right)
+            self._shapes[type, 'left_denotation'] = (
+                'infix_r', binding_power, function
+            )
+            return function
+        return decorate
+
+    def infix_nary(self, type, binding_power):
+        """
+        A decorator for defining associative infix operators.
+
+        Creates a `left_denotation` that collects the operands of consecutive
+        operators of the given `type` and calls the decorated function once,
+        with a list of the operator tokens and a list of the operand
+        expressions::
+
+            @grammar.infix_nary('add', 10)
+            def add(tokens, operands):
+                return sum(operands)
+
+        Compared to :meth:`infix` this avoids a function call and an
+        intermediate result per operator, when parsing long chains such as
+        ``1 + 2 + 3 + ...``.
+        """
+        def decorate(function):
+            @self.left_denotation(type, binding_power)
+            def left_denotation(token, parser, left):
+                tokens = [token]
+                operands = [
+                    left, parser.parse(right_binding_power=binding_power)
+                ]
+                token = parser.advance(type)
+                while token is not None:
+                    tokens.append(token)
+                    operands.append(
+                        parser.parse(right_binding_power=binding_power)
+                    )
+                    token = parser.advance(type)
+                return function(tokens, operands)
+            self._shapes[type, 'left_denotation'] = (
+                'infix_nary', binding_power, function
+            )
             return function
         return decorate
 
@@ -224,10 +620,94 @@ class Grammar(object):
             @self.left_denotation(type, binding_power)
             def left_denotation(token, parser, left):
                 return function(token, left)
+            self._shapes[type, 'left_denotation'] = (
+                'postfix', binding_power, function
+            )
             return function
         return decorate
 
-    def enclosing(self, begin, end, binding_power):
+    def literal_node(self, type, node_type):
+        """
+        Defines a literal, for which `node_type` is called with the token.
+
+        This is equivalent to decorating `node_type` with :meth:`literal`,
+        except that the node is created directly by the `null_denotation`,
+        avoiding a function call for every literal. `node_type` will usually
+        be a :class:`Node` subclass or a :func:`~collections.namedtuple`.
+        """
+        @self.null_denotation(type)
+        def null_denotation(token, parser):
+            return node_type(token)
+        self._shapes[type, 'null_denotation'] = ('literal', node_type)
+
+    def prefix_node(self, type, binding_power, node_type):
+        """
+        Defines a prefix operator, for which `node_type` is called with the
+        token and operand expression.
+
+        This is equivalent to decorating `node_type` with :meth:`prefix`,
+        except that the node is created directly by the `null_denotation`.
+        """
+        @self.null_denotation(type, binding_power)
+        def null_denotation(token, parser):
+            return node_type(
+                token, parser.parse(right_binding_power=binding_power)
+            )
+        self._shapes[type, 'null_denotation'] = (
+            'prefix', binding_power, node_type
+        )
+
+    def infix_node(self, type, binding_power, node_type):
+        """
+        Defines an infix operator, for which `node_type` is called with the
+        token, the left, and right operand expressions.
+
+        This is equivalent to decorating `node_type` with :meth:`infix`,
+        except that the node is created directly by the `left_denotation`.
+        """
+        @self.left_denotation(type, binding_power)
+        def left_denotation(token, parser, left):
+            return node_type(
+                token, left, parser.parse(right_binding_power=binding_power)
+            )
+        self._shapes[type, 'left_denotation'] = (
+            'infix', binding_power, node_type
+        )
+
+    def infix_r_node(self, type, binding_power, node_type):
+        """
+        Defines a right associative infix operator, for which `node_type` is
+        called with the token, the left, and right operand expressions.
+
+        This is equivalent to decorating `node_type` with :meth:`infix_r`,
+        except that the node is created directly by the `left_denotation`.
+        """
+        @self.left_denotation(type, binding_power)
+        def left_denotation(token, parser, left):
+            return node_type(
+                token, left,
+                parser.parse(right_binding_power=binding_power - 1)
+            )
+        self._shapes[type, 'left_denotation'] = (
+            'infix_r', binding_power, node_type
+        )
+
+    def postfix_node(self, type, binding_power, node_type):
+        """
+        Defines a postfix operator, for which `node_type` is called with the
+        token and the operand expression.
+
+        This is equivalent to decorating `node_type` with :meth:`postfix`,
+        except that the node is created directly by the `left_denotation`.
+        """
+        @self.left_denotation(type, binding_power)
+        def left_denotation(token, parser, left):
+            return node_type(token, left)
+        self._shapes[type, 'left_denotation'] = (
+            'postfix', binding_power, node_type
+        )
+
+    def enclosing(self, begin, end, binding_power, lazy=False):
         """
         A decorator for defining expressions that enclose others such as
         parentheses.
@@ -237,18 +717,96 @@ class Grammar(object):
             @grammar.enclosing('(', ')', lbp)
             def parentheses(left, right, body):
                 return body
+
+        If `lazy` is `True`, the tokens up to the matching `end` token are
+        only skipped and `body` is a :class:`Deferred`, that parses them when
+        it's called for the first time. Nested `begin` and `end` tokens are
+        matched, other tokens are not taken into account.
         """
         def decorate(function):
             @self.null_denotation(begin, binding_power)
             def null_denotation(left_token, parser):
-                body = parser.parse()
-                right_token = parser.advance(end)
+                if lazy:
+                    tokens = parser._skip_balanced(begin, end)
+                    right_token = parser.advance(end)
+                    body = parser._defer(tokens, right_token)
+                else:
+                    body = parser.parse()
+                    right_token = parser.advance(end)
                 return function(left_token, right_token, body)
             self.symbol(end)
+            self._shapes[begin, 'null_denotation'] = (
+                'enclosing', end, function
+            )
             return function
         return decorate
 
-    def ternary(self, first_separator, second_separator, binding_power):
+    def sequence(self, begin, separator, end, binding_power=0, lazy=False):
+        """
+        A decorator for defining sequences of expressions, delimited by
+        `begin` and `end` and separated by `separator`, such as lists.
+
+        Usage::
+
+            @grammar.sequence('[', ',', ']')
+            def list_literal(begin, end, elements):
+                return elements
+
+        The elements are parsed in a loop, so even sequences with a very
+        large number of elements don't cause deep recursion.
+
+        If `lazy` is `True`, `elements` is an iterator, that parses the
+        elements from the tokens as they are requested, so that they don't
+        have to be kept in memory, and `end` is a :class:`Deferred`, that
+        returns the `end` token. Calling it, or returning from the decorated
+        function, skips the elements that have not been requested without
+        parsing them, after which `elements` is exhausted. Nested `begin` and
+        `end` tokens are matched, while skipping, other tokens are not taken
+        into account.
+        """
+        def decorate(function):
+            def parse_elements(parser):
+                get_token_type = parser.grammar.get_token_type
+                if get_token_type(parser.token) != end:
+                    yield parser.parse()
+                    while parser.advance(separator) is not None:
+                        yield parser.parse()
+                if get_token_type(parser.token) != end:
+                    self._handle_unexpected_token(parser.token)
+
+            @self.null_denotation(begin, binding_power)
+            def null_denotation(begin_token, parser):
+                if lazy:
+                    elements = parse_elements(parser)
+
+                    def skip_elements():
+                        elements.close()
+                        parser._skip_balanced(begin, end, keep_tokens=False)
+                        return parser.advance(end)
+                    end_token = Deferred(skip_elements)
+                    result = function(begin_token, end_token, elements)
+                    end_token()
+                    return result
+                elements = []
+                end_token = parser.advance(end)
+                if end_token is None:
+                    elements.append(parser.parse())
+                    while parser.advance(separator) is not None:
+                        elements.append(parser.parse())
+                    end_token = parser.advance(end)
+                    if end_token is None:
+                        self._handle_unexpected_token(parser.token)
+                return function(begin_token, end_token, elements)
+            self.symbol(separator)
+            self.symbol(end)
+            self._shapes[begin, 'null_denotation'] = (
+                'sequence', end, function, separator
+            )
+            return function
+        return decorate
+
+    def ternary(self, first_separator, second_separator, binding_power,
+                lazy=False):
         """
         A decorator for defining ternary operators (such as :? or ..if..else).
         Defines a left denotation for the first seperator.
@@ -260,19 +818,45 @@ class Grammar(object):
                 # do something
                 ...
                 return result
+
+        If `lazy` is `True`, the second and third operand are passed to the
+        decorated function as :class:`Deferred` objects, which parse the
+        operands only when they are called. This is useful, if you evaluate
+        expressions while parsing and only need one of the operands.
+
+        Lazy operands are found by skipping tokens without parsing them,
+        which requires the tokens to be defined with decorators such as
+        :meth:`literal`, :meth:`prefix` or :meth:`infix`. If an operand
+        contains other tokens, it's parsed immediately instead.
         """
         def decorate(function):
             @self.left_denotation(first_separator, binding_power)
             def left_denotation(first_sep, parser, first):
-                second = parser.parse()
-                second_sep = parser.advance(second_separator)
-                third = parser.parse()
+                if lazy:
+                    second = parser._parse_deferred()
+                    second_sep = parser.advance(second_separator)
+                    if second_sep is None:
+                        self._handle_unexpected_token(parser.token)
+                    third = parser._parse_deferred()
+                else:
+                    second = parser.parse()
+                    second_sep = parser.advance(second_separator)
+                    third = parser.parse()
                 return function(first_sep, second_sep, first, second, third)
             self.symbol(second_separator)
+            self._shapes[first_separator, 'left_denotation'] = (
+                'ternary', second_separator, function
+            )
             return function
         return decorate
 
 
+    def _handle_unexpected_token(self, token):
+        self.handle_unexpected_token(token)
+        raise RuntimeError(
+            'expected handle_unexpected_token to raise an exception'
+        )
+
     def _get_definition(self, token):
         type = self.get_token_type(token)
         try:
@@ -308,20 +892,416 @@ class Grammar(object):
             return definition['left_denotation'](token, parser, left)
 
 
+class VersionedGrammar(object):
+    """
+    Holds the current version of a grammar, that can be replaced atomically
+    while other threads are parsing with it.
+
+    Each version is a :meth:`frozen <Grammar.freeze>` grammar. Parsers keep
+    the grammar they were created with, so parses that are in progress
+    finish with the version they started with, while parsers created after
+    an update use the new version. Reading the current version doesn't
+    acquire a lock.
+
+    Versions are numbered starting with 1. Use :meth:`snapshot` to get the
+    version number together with the grammar, e.g. to key cached results
+    by the version or the :meth:`~Grammar.fingerprint` of the grammar that
+    produced them.
+    """
+
+    def __init__(self, grammar):
+        self._lock = threading.Lock()
+        self._current = (1, grammar.freeze())
+
+    @property
+    def version(self):
+        """
+        The number of the current version.
+        """
+        return self._current[0]
+
+    @property
+    def grammar(self):
+        """
+        The grammar of the current version.
+        """
+        return self._current[1]
+
+    def snapshot(self):
+        """
+        Returns a tuple ``(version, grammar)`` of the current version.
+        """
+        return self._current
+
+    def parser(self, tokenizer, **kwargs):
+        """
+        Returns a :class:`Parser` for `tokenizer` using the current version.
+        Keyword arguments are passed to the parser.
+        """
+        return Parser(self._current[1], tokenizer, **kwargs)
+
+    def update(self, function):
+        """
+        Creates a new version by calling `function` with an
+        :meth:`extension <Grammar.extend>` of the current grammar, which
+        the function can add definitions to or redefine denotations in.
+        Returns the number of the new version.
+
+        If `function` raises an exception, the current version is kept.
+        """
+        with self._lock:
+            version, grammar = self._current
+            grammar = grammar.extend()
+            function(grammar)
+            return self._swap(version, grammar)
+
+    def swap(self, grammar):
+        """
+        Replaces the current version with `grammar`, which is frozen, and
+        returns the number of the new version.
+        """
+        with self._lock:
+            return self._swap(self._current[0], grammar)
+
+    def _swap(self, version, grammar):
+        # Assigning a single attribute is atomic, so readers see either the
+        # old or the new tuple, never a mix of both.
+        self._current = (version + 1, grammar.freeze())
+        return version + 1
+
+
 class Parser(object):
     """
     A parser that parses the tokens yielded by a `tokenizer` using the
     given `grammar`.
+
+    When parsing untrusted input, you can limit the resources each call to
+    :meth:`parse` may use: `max_tokens` limits the number of tokens that
+    are consumed, `max_depth` how deeply calls to :meth:`parse` may be
+    nested, and `timeout` the number of seconds parsing may take. If a limit
+    is exceeded, :exc:`LimitExceeded` is raised. The timeout is checked
+    every 256 tokens, so it's not exact.
+
+    Pass an :class:`AllocationProfile` as `allocation_profile`, to find out
+    how much memory each denotation allocates, or a :class:`Telemetry` as
+    `telemetry`, to collect statistics about a sample of parses.
+
+    If `memoize` is `True`, the results of :meth:`parse` are remembered
+    while tokens are buffered for a :meth:`mark`, so that parsing the same
+    tokens again after a :meth:`reset` doesn't repeat any work. This
+    requires that the result of parsing only depends on the tokens and the
+    `right_binding_power`.
+
+    If tokens know where they start in the source, pass a function returning
+    that offset for a token as `get_token_offset`, to get the source offsets
+    of :attr:`span` from :attr:`offsets`.
     """
 
-    def __init__(self, grammar, tokenizer):
+    def __init__(self, grammar, tokenizer, max_tokens=None, max_depth=None,
+                 timeout=None, memoize=False, allocation_profile=None,
+                 telemetry=None, get_token_offset=None):
         self.grammar = grammar
         self.tokenizer = tokenizer
+        self.get_token_offset = get_token_offset
+        self.max_tokens = max_tokens
+        self.max_depth = max_depth
+        self.timeout = timeout
+        self.allocation_profile = allocation_profile
+        self.telemetry = telemetry
 
         #: The token after the one that `null_denotation` or `left_denotation`
         #: has been called for.
         self.token = next(tokenizer)
 
+        #: The position of :attr:`token` in the sequence of tokens yielded by
+        #: the `tokenizer`, starting at 0.
+        self.position = 0
+
+        self._start = 0
+        self._start_token = self.token
+        self._depth = 0
+        self._depth_limit = _INFINITY if max_depth is None else max_depth
+        self._token_limit = _INFINITY
+        self._deadline = None
+        # The position at which _check_limits() is called next, this keeps
+        # the cost of limits to a single comparison per token.
+        self._checkpoint = _INFINITY
+        # The time and position at which a sampled parse started and the
+        # name of the exception it raised, if any.
+        self._sample_start = None
+        self._sample_outcome = None
+
+        # Tokens from _buffer_start onwards are kept in the _buffer, while
+        # marks are outstanding or tokens are replayed after a reset.
+        self._buffer = []
+        self._buffer_start = 0
+        self._marks = 0
+        self._memo = None
+        if memoize:
+            self._memo = {}
+            self.parse = self._parse_memoized
+
+        self._call_null_denotation = grammar._call_null_denotation
+        self._call_left_denotation = grammar._call_left_denotation
+        if allocation_profile is not None:
+            self._call_null_denotation = allocation_profile._profile(
+                'null_denotation', grammar._call_null_denotation
+            )
+            self._call_left_denotation = allocation_profile._profile(
+                'left_denotation', grammar._call_left_denotation
+            )
+
+    @property
+    def span(self):
+        """
+        A tuple ``(start, end)`` of the positions of the first token of the
+        expression, that is currently being parsed, and :attr:`token`.
+
+        Within a `null_denotation` or `left_denotation` this covers all
+        tokens consumed for the expression, the denotation is called for,
+        so far. Typically you will want to look at this, after you parsed
+        any operands.
+        """
+        return self._start, self.position
+
+    @property
+    def offsets(self):
+        """
+        A tuple ``(start, end)`` of the source offsets of the tokens at the
+        positions of :attr:`span`, as returned by the `get_token_offset`
+        function passed to the parser, so `end` is the offset of
+        :attr:`token`. The tokenizer should therefore give the token ending
+        the input the length of the source as offset.
+
+        Use a :class:`LineIndex` to turn these into lines and columns, when
+        you need them.
+        """
+        if self.get_token_offset is None:
+            raise RuntimeError('parser has no get_token_offset function')
+        return (
+            self.get_token_offset(self._start_token),
+            self.get_token_offset(self.token)
+        )
+
+    def _start_parse(self):
+        if self.allocation_profile is not None:
+            self.allocation_profile._start_parse()
+        if self.telemetry is not None and self.telemetry._sample():
+            self._sample_start = _clock(), self.position
+            self._sample_outcome = None
+            # While sampling, the depth limit is raised as the parse gets
+            # deeper, so that it ends up being the maximum depth reached,
+            # without adding any cost to parses that are not sampled.
+            self._depth_limit = 1
+        if self.max_tokens is not None:
+            self._token_limit = self.position + self.max_tokens
+        if self.timeout is not None:
+            self._deadline = _clock() + self.timeout
+        self._checkpoint = self._get_checkpoint()
+
+    def _finish_parse(self):
+        # Limits only apply while parsing, not e.g. to advance() calls
+        # between parses.
+        self._token_limit = self._checkpoint = _INFINITY
+        self._deadline = None
+        if self.allocation_profile is not None:
+            self.allocation_profile._finish_parse()
+        if self._sample_start is not None:
+            start, position = self._sample_start
+            self.telemetry._record(
+                _clock() - start, self.position - position,
+                self._depth_limit, self._sample_outcome or 'ok'
+            )
+            self._sample_start = None
+            self._depth_limit = (
+                _INFINITY if self.max_depth is None else self.max_depth
+            )
+
+    def _check_depth(self):
+        if self.max_depth is not None and self._depth >= self.max_depth:
+            raise LimitExceeded('max_depth', self.max_depth)
+        self._depth_limit = self._depth + 1
+
+    def _get_checkpoint(self):
+        if self._deadline is None:
+            return self._token_limit + 1
+        return min(self._token_limit + 1, self.position + _TIMEOUT_INTERVAL)
+
+    def _check_limits(self):
+        if self.position > self._token_limit:
+            raise LimitExceeded('max_tokens', self.max_tokens)
+        if self._deadline is not None and _clock() > self._deadline:
+            raise LimitExceeded('timeout', self.timeout)
+        self._checkpoint = self._get_checkpoint()
+
+    def _next(self):
+        buffer = self._buffer
+        if buffer:
+            index = self.position + 1 - self._buffer_start
+            if index < len(buffer):
+                self.token = buffer[index]
+                if not self._marks and index == len(buffer) - 1:
+                    self._clear_buffer()
+            else:
+                self.token = next(self.tokenizer)
+                if self._marks:
+                    buffer.append(self.token)
+                else:
+                    self._clear_buffer()
+        else:
+            self.token = next(self.tokenizer)
+        self.position += 1
+        if self.position >= self._checkpoint:
+            self._check_limits()
+
+    def mark(self):
+        """
+        Returns a mark for the current position, that can be passed to
+        :meth:`reset` to return to it.
+
+        Consumed tokens are kept in memory, until all marks have been passed
+        to either :meth:`reset` or :meth:`release`.
+        """
+        if not self._buffer:
+            self._buffer.append(self.token)
+            self._buffer_start = self.position
+        self._marks += 1
+        return self.position
+
+    def reset(self, mark):
+        """
+        Returns to the position of the given `mark` and releases it.
+        """
+        if not self._marks or mark < self._buffer_start:
+            raise ValueError('invalid mark: {0!r}'.format(mark))
+        self.position = mark
+        self.token = self._buffer[mark - self._buffer_start]
+        self._release()
+
+    def release(self, mark):
+        """
+        Releases the given `mark`, without changing the position.
+        """
+        if not self._marks or mark < self._buffer_start:
+            raise ValueError('invalid mark: {0!r}'.format(mark))
+        self._release()
+
+    def _release(self):
+        self._marks -= 1
+        if not self._marks:
+            # Keep only the tokens that still have to be replayed.
+            del self._buffer[:self.position - self._buffer_start]
+            self._buffer_start = self.position
+            if len(self._buffer) == 1:
+                self._clear_buffer()
+
+    def _clear_buffer(self):
+        del self._buffer[:]
+        # Memoized results refer to positions in the buffer.
+        if self._memo:
+            self._memo.clear()
+
+    def _skip_balanced(self, begin, end, keep_tokens=True):
+        # Returns the tokens up to the end token matching a begin token, that
+        # has already been consumed, and stops at it. Unless keep_tokens is
+        # true, the tokens are discarded and None is returned.
+        get_token_type = self.grammar.get_token_type
+        tokens = [] if keep_tokens else None
+        depth = 0
+        while True:
+            type = get_token_type(self.token)
+            if type == end:
+                if not depth:
+                    return tokens
+                depth -= 1
+            elif type == begin:
+                depth += 1
+            if keep_tokens:
+                tokens.append(self.token)
+            self._next()
+
+    def _skip_expression(self, right_binding_power):
+        # Consumes the tokens parse() would consume, without parsing them, and
+        # returns them. This is only possible if all tokens are defined with
+        # decorators that record their shape, otherwise None is returned.
+        get_token_type = self.grammar.get_token_type
+        shapes = self.grammar._shapes
+        tokens = []
+        expect_operand = True
+        while True:
+            type = get_token_type(self.token)
+            if expect_operand:
+                shape = shapes.get((type, 'null_denotation'))
+                if shape is None:
+                    return None
+                tokens.append(self.token)
+                self._next()
+                if shape[0] == 'literal':
+                    expect_operand = False
+                elif shape[0] in ('enclosing', 'sequence'):
+                    tokens.extend(self._skip_balanced(type, shape[1]))
+                    tokens.append(self.token)
+                    self._next()
+                    expect_operand = False
+                elif shape[0] != 'prefix':
+                    return None
+            else:
+                left_binding_power = self.grammar._get_left_binding_power(
+                    self.token
+                )
+                if right_binding_power >= left_binding_power:
+                    return tokens
+                shape = shapes.get((type, 'left_denotation'))
+                if shape is None:
+                    return None
+                tokens.append(self.token)
+                self._next()
+                if shape[0] in ('infix', 'infix_r', 'infix_nary'):
+                    expect_operand = True
+                elif shape[0] == 'ternary':
+                    operand = self._skip_expression(0)
+                    if (operand is None or
+                            get_token_type(self.token) != shape[1]):
+                        return None
+                    tokens.extend(operand)
+                    tokens.append(self.token)
+                    self._next()
+                    expect_operand = True
+                elif shape[0] != 'postfix':
+                    return None
+
+    def _parse_deferred(self):
+        # Returns a Deferred for the result of parse(), that parses only when
+        # it's called, if the tokens can be skipped.
+        mark = self.mark()
+        tokens = self._skip_expression(0)
+        if tokens is None:
+            self.reset(mark)
+            result = self.parse()
+            return Deferred(lambda: result)
+        self.release(mark)
+        return self._defer(tokens, self.token)
+
+    def _create_parser(self, tokens):
+        # Returns a parser for the given tokens with the same grammar, limits
+        # and get_token_offset function.
+        return Parser(
+            self.grammar, iter(tokens), max_tokens=self.max_tokens,
+            max_depth=self.max_depth, timeout=self.timeout,
+            get_token_offset=self.get_token_offset
+        )
+
+    def _defer(self, tokens, terminator):
+        # Returns a Deferred that parses the given tokens, followed by the
+        # terminator, with the same grammar and limits.
+        def parse():
+            parser = self._create_parser(tokens + [terminator])
+            result = parser.parse()
+            if parser.position != len(tokens):
+                self.grammar._handle_unexpected_token(parser.token)
+            return result
+        return Deferred(parse)
+
     def advance(self, type):
         """
         Advances past the next token (:attr:`token`) and returns it, if it has
@@ -330,7 +1310,7 @@ class Parser(object):
         """
         if self.grammar.get_token_type(self.token) == type:
             advanced = self.token
-            self.token = next(self.tokenizer)
+            self._next()
             return advanced
 
     def parse(self, right_binding_power=0):
@@ -338,11 +1318,1181 @@ class Parser(object):
         Parses and returns an expression until a token with a `left_binding_power`
         greater than or equal to the given `right_binding_power` is reached.
         """
-        first = self.token
-        self.token = next(self.tokenizer)
-        left = self.grammar._call_null_denotation(first, self)
-        while right_binding_power < self.grammar._get_left_binding_power(self.token):
-            left_token = self.token
-            self.token = next(self.tokenizer)
-            left = self.grammar._call_left_denotation(left_token, self, left)
+        if self._depth == 0:
+            self._start_parse()
+        elif self._depth >= self._depth_limit:
+            self._check_depth()
+        self._depth += 1
+        outer_start = self._start
+        outer_start_token = self._start_token
+        try:
+            start = self._start = self.position
+            first = self._start_token = self.token
+            self._next()
+            left = self._call_null_denotation(first, self)
+            while right_binding_power < self.grammar._get_left_binding_power(self.token):
+                left_token = self.token
+                self._next()
+                self._start = start
+                self._start_token = first
+                left = self._call_left_denotation(left_token, self, left)
+            return left
+        except BaseException as error:
+            if self._depth == 1 and self._sample_start is not None:
+                self._sample_outcome = error.__class__.__name__
+            raise
+        finally:
+            self._start = outer_start
+            self._start_token = outer_start_token
+            self._depth -= 1
+            if not self._depth:
+                self._finish_parse()
+
+    def compile(self, right_binding_power=0):
+        """
+        Like :meth:`parse` but returns the expression as a :class:`Program`.
+
+        Instead of calling the functions associated with tokens, their
+        operations are emitted in postfix order. Only tokens defined with
+        :meth:`~Grammar.literal`, :meth:`~Grammar.prefix`,
+        :meth:`~Grammar.infix`, :meth:`~Grammar.infix_r`,
+        :meth:`~Grammar.infix_nary`, :meth:`~Grammar.postfix`,
+        :meth:`~Grammar.enclosing`, :meth:`~Grammar.sequence`,
+        :meth:`~Grammar.ternary` or the corresponding node factories can be
+        compiled, other tokens cause a :exc:`ValueError`.
+
+        The functions defined for literals are called and their results
+        become the constants of the program. Enclosing expressions only
+        group their body and lazy operands are compiled like eager ones.
+        The limits given to the parser apply as they do for :meth:`parse`.
+        """
+        program = Program()
+        self._compile(right_binding_power, program)
+        return program
+
+    def _get_shape(self, token, denotation):
+        type = self.grammar.get_token_type(token)
+        shape = self.grammar._shapes.get((type, denotation))
+        if shape is None:
+            if self.grammar._get_definition(token)[denotation] is None:
+                self.grammar._handle_unexpected_token(token)
+            raise ValueError('cannot compile {0!r}'.format(type))
+        return type, shape
+
+    def _compile(self, right_binding_power, program):
+        if self._depth == 0:
+            self._start_parse()
+        elif self._depth >= self._depth_limit:
+            self._check_depth()
+        self._depth += 1
+        try:
+            token = self.token
+            type, shape = self._get_shape(token, 'null_denotation')
+            self._next()
+            kind = shape[0]
+            if kind == 'literal':
+                program._push(shape[1](token))
+            elif kind == 'prefix':
+                self._compile(shape[1], program)
+                program._emit(kind, type, 1)
+            elif kind == 'enclosing':
+                self._compile(0, program)
+                self.advance(shape[1])
+            else:
+                end = shape[1]
+                separator = shape[3]
+                arity = 0
+                if self.advance(end) is None:
+                    self._compile(0, program)
+                    arity += 1
+                    while self.advance(separator) is not None:
+                        self._compile(0, program)
+                        arity += 1
+                    if self.advance(end) is None:
+                        self.grammar._handle_unexpected_token(self.token)
+                program._emit(kind, type, arity)
+
+            while right_binding_power < self.grammar._get_left_binding_power(self.token):
+                token = self.token
+                type, shape = self._get_shape(token, 'left_denotation')
+                self._next()
+                kind = shape[0]
+                if kind == 'infix':
+                    self._compile(shape[1], program)
+                    program._emit(kind, type, 2)
+                elif kind == 'infix_r':
+                    self._compile(shape[1] - 1, program)
+                    program._emit(kind, type, 2)
+                elif kind == 'infix_nary':
+                    self._compile(shape[1], program)
+                    arity = 2
+                    while self.advance(type) is not None:
+                        self._compile(shape[1], program)
+                        arity += 1
+                    program._emit(kind, type, arity)
+                elif kind == 'postfix':
+                    program._emit(kind, type, 1)
+                else:
+                    self._compile(0, program)
+                    self.advance(shape[1])
+                    self._compile(0, program)
+                    program._emit(kind, type, 3)
+        except BaseException as error:
+            if self._depth == 1 and self._sample_start is not None:
+                self._sample_outcome = error.__class__.__name__
+            raise
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                self._finish_parse()
+
+    def _parse_memoized(self, right_binding_power=0):
+        if not self._buffer:
+            return Parser.parse(self, right_binding_power)
+        key = self.position, right_binding_power
+        try:
+            succeeded, result, end = self._memo[key]
+        except KeyError:
+            try:
+                result = Parser.parse(self, right_binding_power)
+                succeeded = True
+            except Exception as error:
+                result = error
+                succeeded = False
+            end = self.position
+            # Results can only be reused, while the tokens up to the end
+            # position are buffered.
+            if self._buffer:
+                self._memo[key] = succeeded, result, end
+        else:
+            index = end - self._buffer_start
+            self.position = end
+            self.token = self._buffer[index]
+            if not self._marks and index == len(self._buffer) - 1:
+                self._clear_buffer()
+        if succeeded:
+            return result
+        raise result
+
+
+class Program(object):
+    """
+    An expression in postfix order, as returned by :meth:`Parser.compile`.
+
+    Programs consist of instructions, stored in the arrays :attr:`opcodes`
+    and :attr:`arguments`. An opcode of 0 pushes the constant, its argument
+    refers to, onto a stack. Any other opcode `n` refers to the operation
+    ``operations[n - 1]``, which is applied to as many values from the top
+    of the stack, as its argument specifies.
+
+    Programs are much more compact than trees of objects and can be
+    evaluated without recursion, see :meth:`run`.
+    """
+    __slots__ = (
+        'opcodes', 'arguments', 'constants', 'operations', '_operation_ids'
+    )
+
+    def __init__(self):
+        #: An array of opcodes.
+        self.opcodes = array('i')
+        #: An array with the arguments of the instructions.
+        self.arguments = array('i')
+        #: A list of the constants pushed by the program.
+        self.constants = []
+        #: A list of the operations used by the program. Operations are
+        #: tuples ``(kind, type)``, where `kind` is the name of the
+        #: :class:`Grammar` method used to define the token, such as
+        #: ``'infix'``, and `type` is the type of the token.
+        self.operations = []
+        self._operation_ids = {}
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __eq__(self, other):
+        if not isinstance(other, Program):
+            return NotImplemented
+        return (
+            self.opcodes == other.opcodes and
+            self.arguments == other.arguments and
+            self.constants == other.constants and
+            self.operations == other.operations
+        )
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return (
+            self.opcodes, self.arguments, self.constants, self.operations
+        )
+
+    def __setstate__(self, state):
+        self.opcodes, self.arguments, self.constants, self.operations = state
+        self._operation_ids = dict(
+            (operation, id) for id, operation in enumerate(self.operations, 1)
+        )
+
+    def _push(self, constant):
+        self.opcodes.append(0)
+        self.arguments.append(len(self.constants))
+        self.constants.append(constant)
+
+    def _emit(self, kind, type, arity):
+        operation = kind, type
+        try:
+            opcode = self._operation_ids[operation]
+        except KeyError:
+            self.operations.append(operation)
+            opcode = self._operation_ids[operation] = len(self.operations)
+        self.opcodes.append(opcode)
+        self.arguments.append(arity)
+
+    def run(self, functions):
+        """
+        Evaluates the program with a stack machine and returns the result.
+
+        `functions` maps the :attr:`operations` to functions, which are
+        called with the operands of the operation.
+        """
+        table = [None]
+        table.extend(functions[operation] for operation in self.operations)
+        constants = self.constants
+        stack = []
+        for opcode, argument in zip(self.opcodes, self.arguments):
+            if not opcode:
+                stack.append(constants[argument])
+            elif argument == 2:
+                right = stack.pop()
+                stack[-1] = table[opcode](stack[-1], right)
+            elif argument == 1:
+                stack[-1] = table[opcode](stack[-1])
+            elif argument:
+                operands = stack[-argument:]
+                del stack[-argument:]
+                stack.append(table[opcode](*operands))
+            else:
+                stack.append(table[opcode]())
+        return stack.pop()
+
+
+class Deferred(object):
+    """
+    The result of parsing some tokens, that are only parsed when the deferred
+    is called for the first time. Later calls return the same result.
+    """
+    __slots__ = ('_function', '_result')
+
+    def __init__(self, function):
+        self._function = function
+        self._result = None
+
+    @property
+    def evaluated(self):
+        """
+        `True` if the deferred has been called before.
+        """
+        return self._function is None
+
+    def __call__(self):
+        if self._function is not None:
+            self._result = self._function()
+            self._function = None
+        return self._result
+
+
+_text_type = type(u'')
+_integer_types = (int, type(1 << 64))
+
+# Values in encoded trees are stored as 32-bit words, whose lowest two bits
+# are a tag describing the rest of the word.
+_TAG_RECORD = 0
+_TAG_STRING = 1
+_TAG_INTEGER = 2
+_TAG_CONSTANT = 3
+
+_CONSTANTS = [None, False, True]
+
+_MIN_INTEGER = -(1 << 29)
+_MAX_INTEGER = (1 << 29) - 1
+
+_encoded_header = struct.Struct('<II')
+_encoded_float = struct.Struct('<d')
+
+# Values that don't fit into a word are stored in the string table. Every
+# entry starts with a byte for the kind of value, followed by its encoding.
+_ENTRY_DECODERS = {
+    b't': lambda data: data.decode('utf-8'),
+    b'b': lambda data: data,
+    b'i': int,
+    b'f': lambda data: _encoded_float.unpack(data)[0]
+}
+
+
+def _array_to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+def _bytes_to_words(view):
+    if sys.byteorder == 'little' and hasattr(view, 'cast'):
+        return view.cast('i')
+    words = array('i')
+    if hasattr(words, 'frombytes'):
+        words.frombytes(view.tobytes())
+    else:
+        words.fromstring(view.tobytes())
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+
+def _make_field_getter(node_type, names):
+    # Returns a function that returns the fields of a node as a sequence.
+    if not issubclass(node_type, Node):
+        return tuple
+    if len(names) == 1:
+        get_field = operator.attrgetter(names[0])
+        return lambda node: (get_field(node),)
+    return operator.attrgetter(*names)
+
+
+class NodeCodec(object):
+    """
+    Encodes trees of nodes into a compact binary format and decodes them.
+
+    `node_types` is a list of the :class:`Node` subclasses and
+    :func:`~collections.namedtuple` types, that may appear in trees. The
+    order is part of the format, so the same list has to be used for
+    encoding and decoding, new types should be appended to it.
+
+    Besides nodes, trees may contain tuples, `None`, booleans, integers,
+    floats, text and byte strings. Strings, floats and integers outside of
+    ``-2 ** 29`` to ``2 ** 29 - 1`` are stored once per tree, other values
+    are stored inline. Subtrees, that appear more than once, are stored once
+    per occurrence. Decoded nodes are created by calling their type with the
+    values of their fields, as the node factories of :class:`Grammar` do.
+
+    Encoding and decoding don't use recursion, so they work for trees of any
+    depth.
+
+    Encoding is about as fast as pickling and the result is up to half the
+    size. Decoding a whole tree with :meth:`decode` however happens in
+    Python and is two to three times slower than unpickling it, so
+    :meth:`view` is the fast path, when only parts of a tree are needed.
+    `benchmarks/codec.py` compares both.
+    """
+
+    def __init__(self, node_types):
+        self.node_types = list(node_types)
+        self._type_ids = dict(
+            (node_type, id) for id, node_type in enumerate(self.node_types)
+        )
+        self._field_names = [
+            _get_node_fields(node_type) if issubclass(node_type, Node)
+            else node_type._fields
+            for node_type in self.node_types
+        ]
+        self._field_counts = [len(names) for names in self._field_names]
+        self._get_fields = [
+            _make_field_getter(node_type, names)
+            for node_type, names in zip(self.node_types, self._field_names)
+        ]
+
+    def encode(self, tree):
+        """
+        Returns `tree` encoded as a byte string.
+        """
+        type_ids = self._type_ids
+        get_fields = self._get_fields
+        encode_value = self._encode_value
+        strings = {}
+        words = [0]
+        append = words.append
+        # Tuples of a node or tuple and the index of the word referring to
+        # it, the record for it is appended when it's popped, so that every
+        # subtree is stored contiguously and after its parent.
+        stack = [(tree, 0)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            value, index = pop()
+            type_id = type_ids.get(value.__class__)
+            if type_id is not None:
+                fields = get_fields[type_id](value)
+                header = type_id << 1
+            elif value.__class__ is tuple:
+                fields = value
+                header = len(value) << 1 | 1
+            else:
+                words[index] = encode_value(value, strings)
+                continue
+            words[index] = len(words) << 2 | _TAG_RECORD
+            append(header)
+            for field in fields:
+                if field.__class__ is _text_type:
+                    try:
+                        append(strings[field] << 2 | _TAG_STRING)
+                    except KeyError:
+                        string_id = strings[field] = len(strings)
+                        append(string_id << 2 | _TAG_STRING)
+                elif field.__class__ in type_ids or field.__class__ is tuple:
+                    push((field, len(words)))
+                    append(0)
+                else:
+                    append(encode_value(field, strings))
+
+        # Text strings are keyed by themselves, other values by a tuple of
+        # their kind and encoding.
+        encoded_strings = [None] * len(strings)
+        for key, string_id in strings.items():
+            if key.__class__ is _text_type:
+                encoded_strings[string_id] = b't' + key.encode('utf-8')
+            else:
+                encoded_strings[string_id] = b''.join(key)
+        ends = array('I')
+        end = 0
+        for encoded_string in encoded_strings:
+            end += len(encoded_string)
+            ends.append(end)
+        return b''.join([
+            _encoded_header.pack(len(encoded_strings), end),
+            _array_to_bytes(ends),
+            b''.join(encoded_strings),
+            b'\0' * (-end % 4),
+            _array_to_bytes(array('i', words))
+        ])
+
+    def _encode_value(self, value, strings):
+        if value is None or value is False or value is True:
+            return _CONSTANTS.index(value) << 2 | _TAG_CONSTANT
+        if isinstance(value, _text_type):
+            key = _text_type(value)
+        elif isinstance(value, bytes):
+            key = (b'b', bytes(value))
+        elif isinstance(value, _integer_types):
+            if _MIN_INTEGER <= value <= _MAX_INTEGER:
+                return int(value) << 2 | _TAG_INTEGER
+            key = (b'i', str(int(value)).encode('ascii'))
+        elif isinstance(value, float):
+            # Keyed by the encoding, so that 0.0 and -0.0 are kept apart.
+            key = (b'f', _encoded_float.pack(value))
+        elif isinstance(value, (Node, tuple)):
+            raise ValueError(
+                'unknown node type: {0!r}'.format(value.__class__)
+            )
+        else:
+            raise ValueError('cannot encode {0!r}'.format(value))
+        try:
+            string_id = strings[key]
+        except KeyError:
+            string_id = strings[key] = len(strings)
+        return string_id << 2 | _TAG_STRING
+
+    def decode(self, data):
+        """
+        Decodes and returns a tree encoded with :meth:`encode`. `data` may be
+        a byte string or any other object supporting the buffer protocol.
+
+        This creates every node of the tree, which is slower than
+        unpickling it, use :meth:`view` to only decode the nodes accessed.
+        """
+        tree = _EncodedTree(self, data)
+        word = tree.words[0]
+        if word & 3 == _TAG_RECORD:
+            return tree.materialize(word >> 2)
+        return tree.value(0)
+
+    def view(self, data):
+        """
+        Like :meth:`decode` but returns a :class:`NodeView` for the root of
+        the tree, if it's a node or tuple, which decodes nodes from `data`
+        only when they are accessed, without copying it.
+        """
+        return _EncodedTree(self, data).value(0)
+
+
+class _EncodedTree(object):
+    def __init__(self, codec, data):
+        view = memoryview(data)
+        string_count, string_size = _encoded_header.unpack_from(view)
+        strings_start = _encoded_header.size + 4 * string_count
+        words_start = strings_start + string_size + (-string_size % 4)
+        self.codec = codec
+        self.words = _bytes_to_words(view[words_start:])
+        self._string_ends = _bytes_to_words(
+            view[_encoded_header.size:strings_start]
+        )
+        self._string_data = view[strings_start:strings_start + string_size]
+        self._strings = [None] * string_count
+
+    def string(self, string_id):
+        string = self._strings[string_id]
+        if string is None:
+            start = self._string_ends[string_id - 1] if string_id else 0
+            end = self._string_ends[string_id]
+            data = self._string_data[start:end].tobytes()
+            string = self._strings[string_id] = (
+                _ENTRY_DECODERS[data[:1]](data[1:])
+            )
+        return string
+
+    def value(self, index):
+        # Returns the value of the word at index, nodes and tuples are
+        # returned as views.
+        word = self.words[index]
+        tag = word & 3
+        if tag == _TAG_RECORD:
+            return NodeView(self, word >> 2)
+        if tag == _TAG_STRING:
+            return self.string(word >> 2)
+        if tag == _TAG_INTEGER:
+            return word >> 2
+        return _CONSTANTS[word >> 2]
+
+    def field_count(self, offset):
+        header = self.words[offset]
+        if header & 1:
+            return header >> 1
+        return self.codec._field_counts[header >> 1]
+
+    def materialize(self, offset):
+        # Returns the node or tuple stored at offset, decoded completely. As
+        # subtrees are stored contiguously and after their parents, the
+        # records are found by scanning forward and can then be decoded in
+        # reverse, so that the fields of every record have been decoded
+        # before the record itself.
+        words = self.words
+        if offset == 1 and not isinstance(words, list):
+            # Lists are faster to index than memoryviews.
+            words = self.words = words.tolist()
+        node_types = self.codec.node_types
+        field_counts = self.codec._field_counts
+        offsets = []
+        if offset == 1:
+            # The root of the tree covers all records.
+            end = len(words)
+            while offset < end:
+                offsets.append(offset)
+                header = words[offset]
+                if header & 1:
+                    offset += 1 + (header >> 1)
+                else:
+                    offset += 1 + field_counts[header >> 1]
+        else:
+            pending = 1
+            while pending:
+                offsets.append(offset)
+                header = words[offset]
+                if header & 1:
+                    field_count = header >> 1
+                else:
+                    field_count = field_counts[header >> 1]
+                pending -= 1
+                for word in words[offset + 1:offset + 1 + field_count]:
+                    if word & 3 == _TAG_RECORD:
+                        pending += 1
+                offset += 1 + field_count
+
+        strings = self._strings
+        if None in strings:
+            for string_id in range(len(strings)):
+                self.string(string_id)
+        records = {}
+        for offset in reversed(offsets):
+            header = words[offset]
+            if header & 1:
+                field_count = header >> 1
+            else:
+                field_count = field_counts[header >> 1]
+            fields = []
+            for word in words[offset + 1:offset + 1 + field_count]:
+                tag = word & 3
+                if tag == _TAG_STRING:
+                    fields.append(strings[word >> 2])
+                elif tag == _TAG_RECORD:
+                    fields.append(records.pop(word >> 2))
+                elif tag == _TAG_INTEGER:
+                    fields.append(word >> 2)
+                else:
+                    fields.append(_CONSTANTS[word >> 2])
+            if header & 1:
+                records[offset] = tuple(fields)
+            else:
+                records[offset] = node_types[header >> 1](*fields)
+        return records[offsets[0]]
+
+
+class NodeView(object):
+    """
+    A view of a node or tuple in a tree encoded with
+    :meth:`NodeCodec.encode`, as returned by :meth:`NodeCodec.view`.
+
+    Fields can be accessed by index or, for nodes, by name. Fields that are
+    nodes or tuples are returned as views themselves.
+    """
+    __slots__ = ('_tree', '_offset')
+
+    def __init__(self, tree, offset):
+        self._tree = tree
+        self._offset = offset
+
+    @property
+    def type(self):
+        """
+        The type of the node or :class:`tuple`.
+        """
+        header = self._tree.words[self._offset]
+        if header & 1:
+            return tuple
+        return self._tree.codec.node_types[header >> 1]
+
+    def __len__(self):
+        return self._tree.field_count(self._offset)
+
+    def __getitem__(self, index):
+        field_count = len(self)
+        if index < 0:
+            index += field_count
+        if not 0 <= index < field_count:
+            raise IndexError(index)
+        return self._tree.value(self._offset + 1 + index)
+
+    def __getattr__(self, name):
+        header = self._tree.words[self._offset]
+        if not header & 1:
+            field_names = self._tree.codec._field_names[header >> 1]
+            if name in field_names:
+                return self[list(field_names).index(name)]
+        raise AttributeError(name)
+
+    def materialize(self):
+        """
+        Decodes and returns the node or tuple with all of its fields.
+        """
+        return self._tree.materialize(self._offset)
+
+    def __repr__(self):
+        return '<{0} of {1}>'.format(
+            self.__class__.__name__, self.type.__name__
+        )
+
+
+class AllocationProfile(object):
+    """
+    Collects statistics about the memory allocated by denotations, when
+    passed to a :class:`Parser`.
+
+    Memory is measured with :mod:`tracemalloc`, which is started, if it's
+    not already tracing, when a parser starts parsing. The memory allocated
+    by nested denotations, e.g. for operands, is attributed to those and not
+    to the denotation that triggered them. Only memory that is still in use,
+    when a denotation returns, is counted, so denotations that release the
+    results of nested ones may have negative values. Tracing slows down parsing
+    considerably, so this is intended for finding the denotations worth
+    optimizing and not for use in production.
+
+    Requires Python 3.4 or later.
+    """
+
+    def __init__(self):
+        #: Maps ``(denotation, type)`` tuples, where `denotation` is either
+        #: ``'null_denotation'`` or ``'left_denotation'``, to a list
+        #: ``[calls, bytes, blocks]``. `blocks` is the number of memory
+        #: blocks allocated, which approximates the number of objects.
+        self.rules = {}
+
+        #: The peak memory in bytes traced during each parse, relative to
+        #: the memory in use when it started. Before Python 3.9, the peak
+        #: can't be reset between parses, so it's approximated by the most
+        #: memory in use when any denotation returned.
+        self.peaks = []
+
+        self._started_tracing = False
+        self._parse_start = 0
+        # The most memory in use, when a denotation returned, during the
+        # current parse. Only used, if the peak can't be reset.
+        self._observed_peak = 0
+        # The bytes and blocks allocated by nested denotations, for each
+        # denotation that is currently being called.
+        self._nested = []
+
+    def _start_parse(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self._parse_start = self._observed_peak = (
+            tracemalloc.get_traced_memory()[0]
+        )
+
+    def _finish_parse(self):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        if not hasattr(tracemalloc, 'reset_peak'):
+            peak = max(self._observed_peak, current)
+        self.peaks.append(peak - self._parse_start)
+
+    def _profile(self, denotation, call):
+        import tracemalloc
+        get_traced_memory = tracemalloc.get_traced_memory
+        get_allocated_blocks = sys.getallocatedblocks
+        observe_peak = not hasattr(tracemalloc, 'reset_peak')
+        nested = self._nested
+
+        def profiled(token, parser, *args):
+            type = parser.grammar.get_token_type(token)
+            bytes_before = get_traced_memory()[0]
+            blocks_before = get_allocated_blocks()
+            nested.append([0, 0])
+            try:
+                return call(token, parser, *args)
+            finally:
+                nested_bytes, nested_blocks = nested.pop()
+                bytes_after = get_traced_memory()[0]
+                if observe_peak and bytes_after > self._observed_peak:
+                    self._observed_peak = bytes_after
+                allocated_bytes = bytes_after - bytes_before
+                allocated_blocks = get_allocated_blocks() - blocks_before
+                if nested:
+                    nested[-1][0] += allocated_bytes
+                    nested[-1][1] += allocated_blocks
+                try:
+                    statistics = self.rules[denotation, type]
+                except KeyError:
+                    statistics = self.rules[denotation, type] = [0, 0, 0]
+                statistics[0] += 1
+                statistics[1] += allocated_bytes - nested_bytes
+                statistics[2] += allocated_blocks - nested_blocks
+        return profiled
+
+    def stop(self):
+        """
+        Stops :mod:`tracemalloc`, if it was started by this profile.
+        """
+        import tracemalloc
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def report(self):
+        """
+        Returns a list of dictionaries with the keys `denotation`, `type`,
+        `calls`, `bytes` and `blocks`, one for each denotation that has been
+        called, ordered by the number of bytes allocated in descending order.
+        """
+        report = [
+            {
+                'denotation': denotation,
+                'type': type,
+                'calls': calls,
+                'bytes': bytes,
+                'blocks': blocks
+            }
+            for (denotation, type), (calls, bytes, blocks)
+            in self.rules.items()
+        ]
+        report.sort(key=lambda entry: entry['bytes'], reverse=True)
+        return report
+
+
+def _bucket(value):
+    # Returns the smallest power of two greater than or equal to value.
+    if value <= 1:
+        return max(value, 0)
+    return 1 << (value - 1).bit_length()
+
+
+class Telemetry(object):
+    """
+    Collects statistics about a sample of parses, when passed to any number
+    of :class:`Parser` objects.
+
+    One in `sample_rate` calls to :meth:`Parser.parse`, that are not nested
+    in another, is sampled, starting with the first one. For each sample
+    the duration, the number of tokens consumed, the maximum depth of nested
+    calls to :meth:`Parser.parse` and the outcome are recorded. The outcome
+    is either ``'ok'`` or the name of the exception raised, e.g. by the
+    `handle_unexpected_token` function of the grammar.
+
+    Parses that are not sampled only increment a counter, so this is cheap
+    enough to be used in production.
+    """
+
+    def __init__(self, sample_rate=100):
+        self.sample_rate = sample_rate
+
+        #: Histograms of the durations in microseconds, token counts and
+        #: depths of sampled parses. They map the upper bound of each bucket,
+        #: which is a power of two, to the number of samples in it.
+        self.durations = {}
+        self.tokens = {}
+        self.depths = {}
+
+        #: Maps outcomes to the number of samples with that outcome.
+        self.outcomes = {}
+
+        # Calling next() on a count is atomic, so parsers in different
+        # threads can share the same telemetry. Recording a sample is not,
+        # so that happens under a lock.
+        self._parses = itertools.count()
+        self._samples = 0
+        self._lock = threading.Lock()
+
+    def _sample(self):
+        return next(self._parses) % self.sample_rate == 0
+
+    def _record(self, duration, tokens, depth, outcome):
+        values = [
+            (self.durations, _bucket(int(duration * 1e6))),
+            (self.tokens, _bucket(tokens)),
+            (self.depths, _bucket(depth)),
+            (self.outcomes, outcome)
+        ]
+        with self._lock:
+            self._samples += 1
+            for histogram, value in values:
+                histogram[value] = histogram.get(value, 0) + 1
+
+    def report(self):
+        """
+        Returns a dictionary with the keys `sample_rate`, `samples`,
+        `durations`, `tokens`, `depths` and `outcomes`, whose values are
+        copies of the corresponding histograms.
+        """
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'samples': self._samples,
+                'durations': dict(self.durations),
+                'tokens': dict(self.tokens),
+                'depths': dict(self.depths),
+                'outcomes': dict(self.outcomes)
+            }
+
+
+class ParseCache(object):
+    """
+    A persistent cache for the results of parsing, stored in a
+    :mod:`shelve` at the given `path`.
+
+    Results are keyed by a hash of the source and the
+    :meth:`~Grammar.fingerprint` of the `grammar`, so that they are
+    invalidated automatically, when the grammar changes. The fingerprint is
+    computed, when the cache is opened, so the grammar should not be
+    changed while it's in use. Entries for
+    other grammars are removed, when the cache is opened. Results are only
+    loaded from disk, when they are requested, and have to be picklable.
+
+    Caches can be used as context managers, that close the cache on exit.
+    """
+
+    def __init__(self, path, grammar):
+        import shelve
+        self.grammar = grammar
+        self._shelf = shelve.open(path)
+        self._fingerprint = fingerprint = grammar.fingerprint()
+        if self._shelf.get('fingerprint') != fingerprint:
+            self._shelf.clear()
+            self._shelf['fingerprint'] = fingerprint
+
+    def _get_key(self, source):
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        return '{0}:{1}'.format(
+            self._fingerprint, hashlib.sha1(source).hexdigest()
+        )
+
+    def get(self, source, parse):
+        """
+        Returns the cached result for `source`, if there is one, otherwise
+        calls `parse` with `source` and caches the result.
+        """
+        key = self._get_key(source)
+        try:
+            return self._shelf[key]
+        except KeyError:
+            result = self._shelf[key] = parse(source)
+            return result
+
+    def __contains__(self, source):
+        return self._get_key(source) in self._shelf
+
+    def sync(self):
+        """
+        Writes cached results to disk.
+        """
+        self._shelf.sync()
+
+    def close(self):
+        """
+        Writes cached results to disk and closes the cache.
+        """
+        self._shelf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LineIndex(object):
+    """
+    Maps offsets in a `source` string to lines and columns.
+
+    The index of line starts is only built, when a location is requested for
+    the first time. This allows you to keep track of positions as offsets,
+    which is cheap, and pay for lines and columns only when you need them,
+    e.g. when rendering an error message.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._line_starts = None
+
+    def location(self, offset):
+        """
+        Returns a tuple ``(line, column)`` for the given `offset`. Lines and
+        columns start at 1.
+        """
+        if self._line_starts is None:
+            line_starts = [0]
+            newline = self.source.find('\n')
+            while newline != -1:
+                line_starts.append(newline + 1)
+                newline = self.source.find('\n', newline + 1)
+            self._line_starts = line_starts
+        line = bisect_right(self._line_starts, offset)
+        return line, offset - self._line_starts[line - 1] + 1
+
+
+def parse_concurrently(grammar, tokenizers, max_workers=None):
+    """
+    Parses each of the given `tokenizers` with its own :class:`Parser` in a
+    thread pool with at most `max_workers` threads, and returns a list of
+    the results in the same order.
+
+    `grammar` has to be :meth:`frozen <Grammar.freeze>`, otherwise a
+    :exc:`RuntimeError` is raised. If parsing raises an exception, it's
+    propagated.
+
+    On Python 2 this requires the `futures` backport.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if not grammar.frozen:
+        raise RuntimeError('grammar must be frozen to be used concurrently')
+
+    def parse(tokenizer):
+        return Parser(grammar, tokenizer).parse()
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(parse, tokenizers))
+
+
+# The number of tokens after each point, at which parse_parallel() tries to
+# split an expression, that are looked at to find an operator to split at.
+_PARALLEL_SAMPLE_SIZE = 64
+
+
+def _find_split_points(grammar, tokens, count):
+    # Returns the type of the infix operator, at which the expression should
+    # be split into count runs, and the indices of the operators to split at,
+    # or None if no split points are found. Only a few tokens after each
+    # point are looked at, so whether an operator is at the top-level of the
+    # expression, is only known relative to the other tokens looked at. The
+    # workers parsing the runs verify, that the split points are right.
+    get_token_type = grammar.get_token_type
+    definitions = grammar._definitions
+    opening = set()
+    closing = set()
+    operators = {}
+    for (type, denotation), shape in grammar._shapes.items():
+        if shape[0] in ('enclosing', 'sequence', 'ternary'):
+            opening.add(type)
+            closing.add(shape[1])
+        elif shape[0] in ('infix', 'infix_r', 'infix_nary'):
+            # The binding power, the operator is defined with, may differ
+            # from the left binding power of the token, if it has several
+            # definitions.
+            left_binding_power = definitions[type]['left_binding_power']
+            if left_binding_power == shape[1] and left_binding_power > 0:
+                operators[type] = left_binding_power
+
+    last = len(tokens) - 1
+    step = len(tokens) // count
+    candidates = []
+    for target in [step * i for i in range(1, count)]:
+        # Operators at the lowest depth of nesting seen after the target.
+        lowest = []
+        depth = lowest_depth = 0
+        for index in range(target, min(target + _PARALLEL_SAMPLE_SIZE, last)):
+            type = get_token_type(tokens[index])
+            if type in closing:
+                depth -= 1
+                if depth < lowest_depth:
+                    lowest_depth = depth
+                    lowest = []
+            elif type in opening:
+                depth += 1
+            elif type in operators and depth == lowest_depth:
+                lowest.append((index, type))
+        candidates.append(lowest)
+    level = min([
+        operators[type] for lowest in candidates for _, type in lowest
+    ] or [None])
+    if level is None:
+        return None
+    split_types = set(
+        type for lowest in candidates for _, type in lowest
+        if operators[type] == level
+    )
+    # Chains of different operators with the same binding power can't be
+    # combined in runs.
+    if len(split_types) != 1:
+        return None
+    split_type = split_types.pop()
+    split_points = []
+    for lowest in candidates:
+        for index, type in lowest:
+            if type == split_type and (
+                    not split_points or index > split_points[-1]):
+                split_points.append(index)
+                break
+    if not split_points:
+        return None
+    return split_type, split_points
+
+
+def _fold(kind, function, tokens, operands):
+    # Combines operands separated by the given operator tokens, as the
+    # denotation of an operator of the given kind would.
+    if kind == 'infix_nary':
+        return function(tokens, operands) if tokens else operands[0]
+    elif kind == 'infix':
+        left = operands[0]
+        for token, right in zip(tokens, operands[1:]):
+            left = function(token, left, right)
         return left
+    right = operands[-1]
+    for token, left in zip(reversed(tokens), reversed(operands[:-1])):
+        right = function(token, left, right)
+    return right
+
+
+# The grammar and tokens used by the worker processes of parse_parallel(),
+# which inherit them when they are forked.
+_parallel_grammar = None
+_parallel_tokens = None
+
+
+def _parse_run(arguments):
+    # Parses the operands between start and end, the index of the operator or
+    # terminator following them, and returns a tuple of a flag and their
+    # combined result. The flag is false, if the tokens are not a run of
+    # operands of the given operator, at the top-level of the expression.
+    start, end, type = arguments
+    grammar = _parallel_grammar
+    kind, binding_power, function = grammar._shapes[type, 'left_denotation']
+    # If the operands are parsed exactly as they would be by the operator,
+    # stopping at the token at end, the same tokens are seen as in a parse of
+    # the whole expression. Any other outcome, including reading past end,
+    # means the split points are wrong.
+    try:
+        parser = Parser(grammar, iter(_parallel_tokens[start:end + 1]))
+        tokens = []
+        operands = [parser.parse(binding_power)]
+        while parser.position < end - start:
+            token = parser.advance(type)
+            if token is None:
+                return False, None
+            tokens.append(token)
+            operands.append(parser.parse(binding_power))
+    except Exception:
+        return False, None
+    return True, _fold(kind, function, tokens, operands)
+
+
+def parse_parallel(grammar, tokens, processes=None):
+    """
+    Parses an expression from the given list of `tokens`, which must end with
+    the token ending the expression, using up to `processes` worker
+    processes.
+
+    The expression is split into one run of operands per process, at
+    top-level occurrences of the infix operator with the lowest binding
+    power. Every worker parses and combines the operands of its run and the
+    results are combined according to the associativity of the operator.
+    This speeds up parsing very long flat expressions, such as a sum of
+    millions of terms.
+
+    As operands are combined in runs, the function of the operator has to be
+    associative, like addition, e.g. ``(1 + 2) + (3 + 4)`` is computed
+    instead of ``((1 + 2) + 3) + 4``. For operators defined with
+    :meth:`Grammar.infix_nary` it's called for every run and then for the
+    results of the runs.
+
+    The operator must be defined with :meth:`Grammar.infix`,
+    :meth:`Grammar.infix_r`, :meth:`Grammar.infix_nary` or the
+    corresponding node factories. Split points are chosen by looking at a
+    few tokens only and verified by the workers. If they turn out to be
+    wrong, e.g. because they are within parentheses or the expression
+    contains other operators with the same or a lower binding power, the
+    expression is parsed sequentially.
+
+    Results have to be picklable. Worker processes are forked and inherit
+    `tokens`, so this is only available on platforms supporting
+    :func:`os.fork`, and it must not be called concurrently from several
+    threads.
+    """
+    import multiprocessing
+    global _parallel_grammar, _parallel_tokens
+    if not isinstance(tokens, list):
+        tokens = list(tokens)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    split = None
+    if (processes > 1 and
+            grammar._get_left_binding_power(tokens[-1]) <= 0):
+        split = _find_split_points(grammar, tokens, processes)
+    if split is None:
+        return Parser(grammar, iter(tokens)).parse()
+    type, split_points = split
+
+    runs = [
+        (start, end, type) for start, end in zip(
+            [0] + [index + 1 for index in split_points],
+            split_points + [len(tokens) - 1]
+        )
+    ]
+    if hasattr(multiprocessing, 'get_context'):
+        multiprocessing = multiprocessing.get_context('fork')
+    _parallel_grammar = grammar
+    _parallel_tokens = tokens
+    try:
+        pool = multiprocessing.Pool(len(runs))
+        try:
+            results = pool.map(_parse_run, runs, chunksize=1)
+        finally:
+            pool.terminate()
+    finally:
+        _parallel_grammar = _parallel_tokens = None
+
+    if not all(verified for verified, _ in results):
+        return Parser(grammar, iter(tokens)).parse()
+    kind, _, function = grammar._shapes[type, 'left_denotation']
+    return _fold(
+        kind, function, [tokens[index] for index in split_points],
+        [result for _, result in results]
+    )
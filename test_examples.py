@@ -9,6 +9,8 @@
 import os
 import sys
 
+import pytest
+
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'examples'))
 import math_expr
 
@@ -43,3 +45,140 @@ class TestMath(object):
 
     def test_division_before_subtraction(self):
         assert math_expr.evaluate('2 - 4 / 2') == 0
+
+    def test_conditional(self):
+        assert math_expr.evaluate('1 ? 2 : 3') == 2
+        assert math_expr.evaluate('0 ? 2 : 3') == 3
+        assert math_expr.evaluate('1 + 1 ? 2 * 3 : 4') == 6
+
+    def test_conditional_nested(self):
+        assert math_expr.evaluate('0 ? 1 : 0 ? 2 : 3') == 3
+        assert math_expr.evaluate('1 ? 0 ? 1 : 2 : 3') == 2
+
+    def test_conditional_is_lazy(self):
+        assert math_expr.evaluate('0 ? 1 / 0 : 1') == 1
+        assert math_expr.evaluate('1 ? 1 : (1 / 0)') == 1
+
+    def test_evaluate_program(self):
+        for expression in [
+                '1 + 1', '2 - 1 * 2', '(1 + 1) * 2', '-4 / 2', '+1',
+                '1 ? 2 : 3', '0 ? 1 : 0 ? 2 : 3']:
+            program = math_expr.compile_expression(expression)
+            result = math_expr.evaluate_program(program)
+            assert result == math_expr.evaluate(expression)
+
+    def test_evaluate_program_deep(self):
+        expression = '(' * 500 + '1' + ' + 1)' * 500
+        program = math_expr.compile_expression(expression)
+        assert math_expr.evaluate_program(program) == 501
+
+    def test_evaluate_lines(self):
+        results = math_expr.evaluate_lines([b'1 + 1', b'1 +', b'1 / 0'])
+        assert results[0] == (2, None)
+        assert results[1][0] is None
+        assert results[1][1].startswith('SyntaxError')
+        assert results[2][0] is None
+        assert results[2][1].startswith('ZeroDivisionError')
+
+    def test_read_chunks(self, tmpdir):
+        path = tmpdir.join('expressions.txt')
+        path.write('1\n2\n3\n4\n')
+        chunks = list(math_expr.read_chunks(str(path), 3))
+        assert chunks == [[b'1', b'2'], [b'3', b'4']]
+        path.write('')
+        assert list(math_expr.read_chunks(str(path), 3)) == []
+
+    def test_read_chunks_blank_lines(self, tmpdir):
+        path = tmpdir.join('expressions.txt')
+        path.write('1\n\n2\n\n\n3\n4\n')
+        expected = [b'1', b'', b'2', b'', b'', b'3', b'4']
+        for chunk_size in [0, 1, 2, 3, 100]:
+            chunks = list(math_expr.read_chunks(str(path), chunk_size))
+            assert sum(chunks, []) == expected
+            chunks = math_expr.read_chunks(str(path), chunk_size, split=False)
+            assert b'\n'.join(chunks).split(b'\n') == expected
+
+    def test_tokenize_bulk(self):
+        pytest.importorskip('numpy')
+        data = b'12 + (3*45)\n?: -x'
+        types, starts, ends = math_expr.tokenize_bulk(data)
+        assert [math_expr.bulk_types[type] for type in types] == [
+            'int', 'add', 'left_paren', 'int', 'mul', 'int', 'right_paren',
+            'newline', 'question', 'colon', 'sub', 'unknown'
+        ]
+        assert [data[start:end] for start, end in zip(starts, ends)] == [
+            b'12', b'+', b'(', b'3', b'*', b'45', b')', b'\n', b'?', b':',
+            b'-', b'x'
+        ]
+        assert [len(array) for array in math_expr.tokenize_bulk(b'')] == [
+            0, 0, 0
+        ]
+
+    def test_evaluate_buffer(self):
+        pytest.importorskip('numpy')
+        lines = [b'1 + 1', b'1 +', b'1 / 0', b'', b'(10 - 2) * 3', b'0 ? 1 : 2']
+        data = b'\n'.join(lines)
+        assert math_expr.evaluate_buffer(data) == math_expr.evaluate_lines(lines)
+        result, error = math_expr.evaluate_buffer(b'1 + x')[0]
+        assert result is None
+        assert error.startswith('SyntaxError')
+
+    def test_main_file(self, tmpdir, capsys):
+        source = tmpdir.join('expressions.txt')
+        output = tmpdir.join('results.txt')
+        expressions = ['{} * 2'.format(i) for i in range(1000)] + ['1 +']
+        source.write('\n'.join(expressions) + '\n')
+        exit_code = math_expr.main([
+            '--file', str(source), '--output', str(output), '--jobs', '2',
+            '--chunk-size', '100'
+        ])
+        assert exit_code == 1
+        lines = output.read().splitlines()
+        assert lines[:1000] == [str(i * 2) for i in range(1000)]
+        assert lines[1000].startswith('error: SyntaxError')
+        assert '1001 expressions, 1 errors' in capsys.readouterr().err
+
+    def test_evaluate_file_bounded(self, tmpdir, monkeypatch):
+        source = tmpdir.join('expressions.txt')
+        source.write('\n'.join(str(i) for i in range(200)) + '\n')
+        read = []
+        read_chunks = math_expr.read_chunks
+        def counting_read_chunks(*args, **kwargs):
+            for chunk in read_chunks(*args, **kwargs):
+                read.append(chunk)
+                yield chunk
+
+        class Output(object):
+            def __init__(self):
+                self.lines = []
+                self.read_ahead = 0
+
+            def write(self, line):
+                self.lines.append(line)
+                self.read_ahead = max(
+                    self.read_ahead, len(read) - len(self.lines)
+                )
+
+        monkeypatch.setattr(math_expr, 'read_chunks', counting_read_chunks)
+        output = Output()
+        # With a chunk size of 1, every line is a chunk of its own.
+        assert math_expr.evaluate_file(str(source), output, 2, 1) == (200, 0)
+        assert output.lines == ['{}\n'.format(i) for i in range(200)]
+        assert len(read) == 200
+        assert output.read_ahead <= 4
+
+    def test_main_file_bulk(self, tmpdir, capsys):
+        pytest.importorskip('numpy')
+        source = tmpdir.join('expressions.txt')
+        output = tmpdir.join('results.txt')
+        expressions = ['{} * 2'.format(i) for i in range(1000)] + ['1 +']
+        source.write('\n'.join(expressions) + '\n')
+        exit_code = math_expr.main([
+            '--file', str(source), '--output', str(output), '--jobs', '2',
+            '--chunk-size', '100', '--bulk'
+        ])
+        assert exit_code == 1
+        lines = output.read().splitlines()
+        assert lines[:1000] == [str(i * 2) for i in range(1000)]
+        assert lines[1000].startswith('error: SyntaxError')
+        assert '1001 expressions, 1 errors' in capsys.readouterr().err
@@ -0,0 +1,69 @@
+# encoding: utf-8
+"""
+    test_math_server
+    ~~~~~~~~~~~~~~~~
+
+    Tests for `examples/math_server.py`, which requires Python 3.7 or later,
+    this module is therefore ignored on earlier versions, see `conftest.py`.
+
+    :copyright: 2015 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'examples'))
+import math_expr
+import math_server
+
+
+class TestMathServer(object):
+    """
+    Tests for the `examples/math_server.py` module.
+    """
+    def run(self, coroutine_function):
+        with ThreadPoolExecutor(2) as executor:
+            return asyncio.run(coroutine_function(executor))
+
+    def test_batch_evaluator(self):
+        async def test(executor):
+            evaluator = math_server.BatchEvaluator(
+                executor, max_batch_size=10, max_delay=0.01
+            )
+            evaluator.start()
+            expressions = ['1 + 1', '2 * 3', '1 + 1', '1 / 0'] * 5
+            results = await asyncio.gather(
+                *[evaluator.evaluate(e) for e in expressions],
+                return_exceptions=True
+            )
+            await evaluator.close()
+            for expression, result in zip(expressions, results):
+                if expression == '1 / 0':
+                    assert isinstance(result, math_server.EvaluationError)
+                else:
+                    assert result == math_expr.evaluate(expression)
+            statistics = evaluator.statistics()
+            assert statistics['requests'] == 20
+            assert statistics['errors'] == 5
+            assert statistics['batches'] == 2
+            assert statistics['evaluated'] == 6
+        self.run(test)
+
+    def test_server(self):
+        async def test(executor):
+            server = math_server.Server(math_server.BatchEvaluator(executor))
+            host, port = await server.start()
+            expressions = ['1 + 1', '2 * 3', '1 +']
+            responses = await math_server.generate_load(
+                host, port, 4, 50, expressions
+            )
+            await server.close()
+            for client_responses in responses:
+                assert len(client_responses) == 50
+                assert set(client_responses) <= {
+                    '2', '6', 'error: SyntaxError: unexpected end'
+                }
+            assert server.evaluator.statistics()['requests'] == 200
+        self.run(test)
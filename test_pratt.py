@@ -7,9 +7,20 @@
     :license: BSD, see LICENSE.rst for details
 """
 import re
+import pickle
+import operator
+import functools
+import threading
+from collections import namedtuple
 
-from pratt import Grammar, Parser, UnexpectedToken
+from pratt import (
+    Grammar, Parser, Node, Deferred, Program, LineIndex, AllocationProfile,
+    Telemetry, NodeCodec, NodeView,
+    PrattException, UnexpectedToken, LimitExceeded, ParseCache,
+    VersionedGrammar, parse_concurrently, parse_parallel
+)
 
+import pytest
 from pytest import raises
 
 
@@ -25,6 +36,10 @@ def _tokenizer(string):
     return iter(re.findall(r'\+|\-|\*\*|\*|/|\(|\)|\d+', string) + ['EOF'])
 
 
+def _tokenizer_with_commas(string):
+    return iter(re.findall(r'\+|\d+|,', string) + ['EOF'])
+
+
 def test_handle_unexpected_token_is_called():
     callback_called = [False]
     def handle_unexpected_token(token):
@@ -278,3 +293,1238 @@ def test_advance_failure():
     parser = Parser(grammar, iter(['a', 'EOF']))
     result = parser.parse()
     assert result == 'a'
+
+
+def _math_grammar():
+    grammar = Grammar(_get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    @grammar.literal('integer')
+    def integer(token):
+        return int(token)
+    @grammar.infix('+', 10)
+    def add(token, left, right):
+        return left + right
+    @grammar.infix('*', 20)
+    def mul(token, left, right):
+        return left * right
+    return grammar
+
+
+def test_extend_inherits_definitions():
+    grammar = _math_grammar().extend()
+    parser = Parser(grammar, _tokenizer('1 + 2 * 3'))
+    assert parser.parse() == 7
+
+
+def test_extend_adds_definitions():
+    base = _math_grammar()
+    grammar = base.extend()
+    @grammar.infix('-', 10)
+    def sub(token, left, right):
+        return left - right
+    parser = Parser(grammar, _tokenizer('3 - 1'))
+    assert parser.parse() == 2
+    assert '-' not in base._definitions
+
+
+def test_extend_redefines_definitions():
+    base = _math_grammar()
+    grammar = base.extend()
+    @grammar.infix('+', 30)
+    def add(token, left, right):
+        return left + right
+    parser = Parser(grammar, _tokenizer('2 * 3 + 1'))
+    assert parser.parse() == 8
+    parser = Parser(base, _tokenizer('2 * 3 + 1'))
+    assert parser.parse() == 7
+
+
+def test_extend_redefinition_keeps_other_denotation():
+    base = _math_grammar()
+    @base.prefix('+', 100)
+    def positive(token, operand):
+        return operand
+    grammar = base.extend()
+    @grammar.infix('+', 10)
+    def add(token, left, right):
+        return left - right
+    parser = Parser(grammar, _tokenizer('+3 + 1'))
+    assert parser.parse() == 2
+    with raises(RuntimeError):
+        grammar.infix('+', 10)(add)
+
+
+def test_extend_redefinition_keeps_binding_power_of_other_denotation():
+    base = _math_grammar()
+    @base.enclosing('(', ')', 0)
+    def parentheses(left, right, body):
+        return body
+    @base.left_denotation('(', 80)
+    def call(token, parser, left):
+        argument = parser.parse()
+        parser.advance(')')
+        return ('call', left, argument)
+    grammar = base.extend()
+    @grammar.enclosing('(', ')', 0)
+    def tuple_or_parentheses(left, right, body):
+        return (body,)
+    parser = Parser(grammar, iter(['2', '(', '3', ')', 'EOF']))
+    assert parser.parse() == ('call', 2, 3)
+    parser = Parser(grammar, iter(['(', '3', ')', 'EOF']))
+    assert parser.parse() == (3,)
+
+
+class _Literal(Node):
+    __slots__ = ('token',)
+
+
+class _Operation(Node):
+    __slots__ = ('operator', 'left', 'right')
+
+
+def test_node():
+    node = _Operation('+', 1, 2)
+    assert node.operator == '+'
+    assert node.left == 1
+    assert node.right == 2
+    assert node == _Operation('+', 1, 2)
+    assert node != _Operation('+', 2, 1)
+    assert repr(node) == "_Operation('+', 1, 2)"
+    assert not hasattr(node, '__dict__')
+    with raises(TypeError):
+        _Operation('+', 1)
+
+
+def test_node_inheritance():
+    class Add(_Operation):
+        __slots__ = ()
+    class Annotated(_Operation):
+        __slots__ = ('annotation', )
+    node = Add('+', 1, 2)
+    assert (node.operator, node.left, node.right) == ('+', 1, 2)
+    assert node == Add('+', 1, 2)
+    assert node != _Operation('+', 1, 2)
+    assert repr(node) == "Add('+', 1, 2)"
+    node = Annotated('+', 1, 2, 'int')
+    assert node.annotation == 'int'
+    assert node != Annotated('+', 1, 2, 'float')
+    with raises(TypeError):
+        Annotated('+', 1, 2)
+
+
+def test_node_init():
+    class Custom(_Operation):
+        __slots__ = ()
+        def __init__(self, operator, operand):
+            super(Custom, self).__init__(operator, operand, None)
+    class CustomChild(Custom):
+        __slots__ = ()
+    class Self(Node):
+        __slots__ = ('self', 'self_')
+    assert CustomChild('-', 1) == CustomChild('-', 1)
+    assert CustomChild('-', 1).right is None
+    node = Self(1, 2)
+    assert (node.self, node.self_) == (1, 2)
+    assert _Operation(operator='+', left=1, right=2) == _Operation('+', 1, 2)
+
+
+def test_node_deep_equality():
+    def build(depth, right):
+        tree = _Literal('0')
+        for i in range(depth):
+            tree = _Operation('+', tree, _Literal(right))
+        return tree
+    assert build(10000, '1') == build(10000, '1')
+    assert build(10000, '1') != build(10000, '2')
+
+
+def test_node_factories():
+    Unary = namedtuple('Unary', ['operator', 'operand'])
+    grammar = Grammar(_get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    grammar.literal_node('integer', _Literal)
+    grammar.prefix_node('-', 100, Unary)
+    grammar.infix_node('+', 10, _Operation)
+    grammar.infix_r_node('**', 30, _Operation)
+    grammar.postfix_node('/', 40, Unary)
+    parser = Parser(grammar, _tokenizer('-1 + 2 ** 3 ** 4/'))
+    assert parser.parse() == _Operation(
+        '+',
+        Unary('-', _Literal('1')),
+        _Operation(
+            '**', _Literal('2'),
+            _Operation('**', _Literal('3'), Unary('/', _Literal('4')))
+        )
+    )
+
+
+def test_freeze():
+    grammar = _math_grammar()
+    assert not grammar.frozen
+    assert grammar.freeze() is grammar
+    assert grammar.frozen
+    with raises(RuntimeError):
+        grammar.symbol('-')
+    parser = Parser(grammar, _tokenizer('1 + 2'))
+    assert parser.parse() == 3
+
+
+def test_extend_frozen():
+    grammar = _math_grammar().freeze().extend()
+    assert not grammar.frozen
+    grammar.symbol('-')
+
+
+def test_parse_concurrently():
+    pytest.importorskip('concurrent.futures')
+    grammar = _math_grammar().freeze()
+    sources = ['{0} + {0} * 2'.format(i) for i in range(100)]
+    results = parse_concurrently(
+        grammar, [_tokenizer(source) for source in sources], 4
+    )
+    assert results == [i * 3 for i in range(100)]
+
+
+def test_parse_concurrently_requires_frozen_grammar():
+    pytest.importorskip('concurrent.futures')
+    with raises(RuntimeError):
+        parse_concurrently(_math_grammar(), [_tokenizer('1')])
+
+
+def _subtract(grammar):
+    @grammar.infix('+', 10)
+    def add(token, left, right):
+        return left - right
+
+
+def test_versioned_grammar():
+    versioned = VersionedGrammar(_math_grammar())
+    version, grammar = versioned.snapshot()
+    assert version == versioned.version == 1
+    assert grammar is versioned.grammar
+    assert grammar.frozen
+
+    def tokenizer():
+        # Updates the grammar, while the parser is in the middle of parsing.
+        for token in _tokenizer('3 + 1 + 1'):
+            if token == '1' and versioned.version == 1:
+                versioned.update(_subtract)
+            yield token
+    parser = versioned.parser(tokenizer())
+    assert parser.parse() == 5
+    assert versioned.version == 2
+    assert versioned.grammar.frozen
+    assert versioned.grammar.fingerprint() != grammar.fingerprint()
+    assert versioned.parser(_tokenizer('3 + 1')).parse() == 2
+    assert Parser(grammar, _tokenizer('3 + 1')).parse() == 4
+
+    assert versioned.swap(_math_grammar()) == 3
+    assert versioned.parser(_tokenizer('3 + 1'), max_tokens=10).parse() == 4
+    assert versioned.grammar.fingerprint() == grammar.fingerprint()
+
+
+def test_versioned_grammar_update_failure():
+    versioned = VersionedGrammar(_math_grammar())
+    grammar = versioned.grammar
+    def update(grammar):
+        _subtract(grammar)
+        raise ValueError()
+    with raises(ValueError):
+        versioned.update(update)
+    assert versioned.snapshot() == (1, grammar)
+
+
+def test_parser_position():
+    grammar = _math_grammar()
+    parser = Parser(grammar, _tokenizer('1 + 2'))
+    assert parser.position == 0
+    parser.parse()
+    assert parser.position == 3
+    assert parser.token == 'EOF'
+
+
+def test_parser_span():
+    spans = []
+    grammar = Grammar(_get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    @grammar.null_denotation('integer')
+    def integer(token, parser):
+        spans.append((token, parser.span))
+        return token
+    @grammar.prefix('-', 100)
+    def neg(token, operand):
+        spans.append((token, parser.span))
+        return token
+    @grammar.infix('+', 10)
+    def add(token, left, right):
+        spans.append((token, parser.span))
+        return token
+    @grammar.enclosing('(', ')', 0)
+    def parentheses(left, right, body):
+        spans.append((left, parser.span))
+        return body
+    parser = Parser(grammar, _tokenizer('1 + (-2 + 3)'))
+    parser.parse()
+    assert spans == [
+        ('1', (0, 1)),
+        ('2', (4, 5)),
+        ('-', (3, 5)),
+        ('3', (6, 7)),
+        ('+', (3, 7)),
+        ('(', (2, 8)),
+        ('+', (0, 8)),
+    ]
+
+
+def test_line_index():
+    index = LineIndex('1 +\n  2\n\n3')
+    assert index.location(0) == (1, 1)
+    assert index.location(2) == (1, 3)
+    assert index.location(3) == (1, 4)
+    assert index.location(4) == (2, 1)
+    assert index.location(6) == (2, 3)
+    assert index.location(8) == (3, 1)
+    assert index.location(9) == (4, 1)
+
+
+def test_parser_offsets():
+    source = '1 +\n  (2 +\n   30)'
+    def tokenize():
+        for match in re.finditer(r'\d+|\S', source):
+            yield match.group(), match.start()
+        yield 'EOF', len(source)
+    def get_token_type(token):
+        return 'integer' if token[0].isdigit() else token[0]
+    index = LineIndex(source)
+    locations = []
+    grammar = Grammar(get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    grammar.literal('integer')(lambda token: int(token[0]))
+    @grammar.infix('+', 10)
+    def add(token, left, right):
+        start, end = parser.offsets
+        locations.append((source[start:end].rstrip(), index.location(start)))
+        return left + right
+    @grammar.enclosing('(', ')', 0)
+    def parentheses(left, right, body):
+        return body
+    parser = Parser(grammar, tokenize(), get_token_offset=lambda t: t[1])
+    assert parser.parse() == 33
+    assert locations == [
+        ('2 +\n   30', (2, 4)),
+        ('1 +\n  (2 +\n   30)', (1, 1))
+    ]
+    with raises(RuntimeError):
+        Parser(grammar, tokenize()).offsets
+
+
+def test_max_tokens():
+    grammar = _math_grammar()
+    parser = Parser(grammar, _tokenizer('1 + 2 + 3'), max_tokens=5)
+    assert parser.parse() == 6
+
+    parser = Parser(grammar, _tokenizer('1 + 2 + 3'), max_tokens=4)
+    with raises(LimitExceeded) as exc_info:
+        parser.parse()
+    assert exc_info.value.limit == 'max_tokens'
+    assert exc_info.value.value == 4
+    assert isinstance(exc_info.value, PrattException)
+
+
+def test_max_depth():
+    grammar = _math_grammar()
+    @grammar.enclosing('(', ')', 0)
+    def parentheses(left, right, body):
+        return body
+    parser = Parser(grammar, _tokenizer('((1))'), max_depth=3)
+    assert parser.parse() == 1
+
+    parser = Parser(grammar, _tokenizer('(((1)))'), max_depth=3)
+    with raises(LimitExceeded) as exc_info:
+        parser.parse()
+    assert exc_info.value.limit == 'max_depth'
+
+
+def test_timeout():
+    grammar = _math_grammar()
+    source = ' + '.join(['1'] * 1000)
+    parser = Parser(grammar, _tokenizer(source), timeout=10)
+    assert parser.parse() == 1000
+
+    parser = Parser(grammar, _tokenizer(source), timeout=0)
+    with raises(LimitExceeded) as exc_info:
+        parser.parse()
+    assert exc_info.value.limit == 'timeout'
+
+
+def test_limits_apply_per_parse():
+    grammar = _math_grammar()
+    grammar.symbol(',')
+    parser = Parser(grammar, _tokenizer_with_commas('1 + 2, 3 + 4'),
+                    max_tokens=4)
+    assert parser.parse() == 3
+    assert parser.advance(',') == ','
+    assert parser.parse() == 7
+
+
+def test_limits_do_not_apply_between_parses():
+    grammar = _math_grammar()
+    grammar.symbol(',')
+    # The limit is exactly the number of tokens in each expression.
+    parser = Parser(grammar, _tokenizer_with_commas('1 + 2, 3 + 4'),
+                    max_tokens=3)
+    assert parser.parse() == 3
+    assert parser.advance(',') == ','
+    assert parser.parse() == 7
+
+
+def test_mark_reset():
+    grammar = _math_grammar()
+    parser = Parser(grammar, _tokenizer('1 + 2 * 3'))
+    mark = parser.mark()
+    assert parser.parse() == 7
+    assert parser.token == 'EOF'
+    parser.reset(mark)
+    assert parser.position == 0
+    assert parser.token == '1'
+    assert parser.parse() == 7
+    assert parser._buffer == []
+
+
+def test_mark_release():
+    grammar = _math_grammar()
+    parser = Parser(grammar, _tokenizer('1 + 2 * 3'))
+    mark = parser.mark()
+    assert parser.parse(right_binding_power=10) == 1
+    parser.release(mark)
+    assert parser._buffer == []
+    assert parser.token == '+'
+    with raises(ValueError):
+        parser.reset(mark)
+
+
+def test_mark_nested():
+    grammar = _math_grammar()
+    parser = Parser(grammar, _tokenizer('1 + 2 * 3'))
+    outer = parser.mark()
+    parser.parse(right_binding_power=10)
+    parser.advance('+')
+    inner = parser.mark()
+    assert parser.parse() == 6
+    parser.reset(inner)
+    assert parser.token == '2'
+    parser.reset(outer)
+    assert parser.token == '1'
+    assert parser.parse() == 7
+    assert parser._buffer == []
+
+
+def _cast_grammar():
+    grammar = Grammar(_get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    grammar.symbol(')')
+    grammar.symbol('T')
+    @grammar.literal('integer')
+    def integer(token):
+        return int(token)
+    @grammar.null_denotation('(')
+    def cast_or_parentheses(token, parser):
+        mark = parser.mark()
+        if parser.advance('T') and parser.advance(')'):
+            parser.release(mark)
+            return ('cast', parser.parse(100))
+        parser.reset(mark)
+        body = parser.parse()
+        parser.advance(')')
+        return body
+    return grammar
+
+
+def test_mark_reset_ambiguity():
+    grammar = _cast_grammar()
+    parser = Parser(grammar, iter(['(', 'T', ')', '1', 'EOF']))
+    assert parser.parse() == ('cast', 1)
+    parser = Parser(grammar, iter(['(', '1', ')', 'EOF']))
+    assert parser.parse() == 1
+
+
+def test_memoize():
+    calls = []
+    grammar = _math_grammar()
+    @grammar.literal('-')
+    def fail(token):
+        calls.append(token)
+        raise ValueError(token)
+    @grammar.prefix('/', 100)
+    def prefix(token, operand):
+        calls.append(token)
+        return operand
+    parser = Parser(grammar, _tokenizer('/1 + 2 * -'), memoize=True)
+    mark = parser.mark()
+    assert parser.parse(right_binding_power=10) == 1
+    parser.reset(mark)
+    mark = parser.mark()
+    with raises(ValueError):
+        parser.parse()
+    parser.reset(mark)
+    mark = parser.mark()
+    assert parser.parse(right_binding_power=10) == 1
+    assert parser.token == '+'
+    parser.reset(mark)
+    mark = parser.mark()
+    with raises(ValueError):
+        parser.parse()
+    assert calls == ['/', '/', '-']
+
+
+def test_memoize_clears_memo():
+    grammar = _math_grammar()
+    parser = Parser(grammar, _tokenizer('1 + 2 * 3'), memoize=True)
+    mark = parser.mark()
+    assert parser.parse() == 7
+    assert parser._memo
+    parser.reset(mark)
+    assert parser._memo
+    assert parser.parse() == 7
+    assert parser.token == 'EOF'
+    assert not parser._buffer
+    assert not parser._memo
+
+
+def _node_grammar():
+    grammar = Grammar(_get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    grammar.literal_node('integer', _Literal)
+    grammar.infix_node('+', 10, _Operation)
+    grammar.infix_node('-', 10, _Operation)
+    grammar.infix_node('*', 20, _Operation)
+    grammar.infix_r_node('**', 30, _Operation)
+    grammar.prefix_node('/', 100, _Operation)
+    @grammar.enclosing('(', ')', 0)
+    def parentheses(left, right, body):
+        return body
+    return grammar
+
+
+def _parallel_grammar():
+    grammar = _math_grammar()
+    @grammar.enclosing('(', ')', 0)
+    def parentheses(left, right, body):
+        return body
+    @grammar.infix_r('**', 30)
+    def concatenate(token, left, right):
+        return int(str(left) + str(right))
+    return grammar
+
+
+def test_parse_parallel():
+    grammar = _parallel_grammar()
+    source = ' + '.join('{0} * ({0} + 1) * 2'.format(i) for i in range(1000))
+    tokens = list(_tokenizer(source))
+    expected = Parser(grammar, iter(tokens)).parse()
+    for processes in [1, 2, 3, 8]:
+        assert parse_parallel(grammar, tokens, processes) == expected
+    assert parse_parallel(grammar, iter(tokens), 2) == expected
+    assert parse_parallel(grammar, tokens[-2:], 8) == 2
+
+    # Only the results of the runs are added in this process.
+    calls = []
+    grammar = grammar.extend()
+    @grammar.infix('+', 10)
+    def add(token, left, right):
+        calls.append(token)
+        return left + right
+    assert parse_parallel(grammar, tokens, 3) == expected
+    assert calls == ['+', '+']
+
+
+def test_parse_parallel_right_associative():
+    grammar = _parallel_grammar()
+    tokens = list(_tokenizer(' ** '.join(str(i % 9 + 1) for i in range(20))))
+    expected = Parser(grammar, iter(tokens)).parse()
+    assert parse_parallel(grammar, tokens, 2) == expected
+    assert parse_parallel(grammar, tokens, 3) == expected
+
+
+def test_parse_parallel_fallback():
+    grammar = _node_grammar()
+    @grammar.prefix('-', 5)
+    def negative(token, operand):
+        return ('-', operand)
+    @grammar.left_denotation('/', 40)
+    def custom(token, parser, left):
+        return ('/', left)
+    # Split points within parentheses, operands that extend past them and
+    # lower operators that are not sampled, can't be split and have to be
+    # parsed sequentially, which keeps the order of operations of
+    # the nodes.
+    for source in [
+            '-1 + 2 + 3', '(1 + 2 + 3 + 4)', '1',
+            ' * '.join(['1'] * 100) + ' + 1 * 2']:
+        tokens = list(_tokenizer(source))
+        expected = Parser(grammar, iter(tokens)).parse()
+        assert parse_parallel(grammar, tokens, 2) == expected
+    with raises(AssertionError):
+        parse_parallel(grammar, list(_tokenizer('1 + + 2 + 3')), 2)
+
+
+def test_allocation_profile():
+    pytest.importorskip('tracemalloc')
+    grammar = Grammar(_get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    @grammar.literal('integer')
+    def integer(token):
+        return int(token)
+    @grammar.infix('+', 10)
+    def add(token, left, right):
+        return [left, right] * 1000
+    profile = AllocationProfile()
+    try:
+        parser = Parser(grammar, _tokenizer('1 + 2 + 3'),
+                        allocation_profile=profile)
+        result = parser.parse()
+        assert len(result) == 2000
+        del result
+        parser = Parser(grammar, _tokenizer('1'), allocation_profile=profile)
+        assert parser.parse() == 1
+    finally:
+        profile.stop()
+    report = profile.report()
+    assert [(entry['denotation'], entry['type']) for entry in report] == [
+        ('left_denotation', '+'),
+        ('null_denotation', 'integer'),
+    ]
+    assert report[0]['calls'] == 2
+    assert report[0]['bytes'] >= 2 * 1000 * 8
+    assert report[0]['blocks'] >= 1
+    assert report[1]['calls'] == 4
+    assert len(profile.peaks) == 2
+    assert profile.peaks[0] >= report[0]['bytes']
+    # The peak of the second parse doesn't include the first one.
+    assert profile.peaks[1] < profile.peaks[0] / 2
+
+
+def test_telemetry():
+    grammar = _math_grammar()
+    telemetry = Telemetry(sample_rate=2)
+    for source in ['1 + 2 * 3', '1', '1 + 2', '1 * 2 * 3 * 4 * 5', '1']:
+        parser = Parser(grammar, _tokenizer(source), telemetry=telemetry)
+        parser.parse()
+    report = telemetry.report()
+    assert report['sample_rate'] == 2
+    assert report['samples'] == 3
+    assert report['tokens'] == {1: 1, 4: 1, 8: 1}
+    assert report['depths'] == {1: 1, 2: 1, 4: 1}
+    assert report['outcomes'] == {'ok': 3}
+    assert sum(report['durations'].values()) == 3
+
+
+def test_telemetry_outcome():
+    grammar = Grammar(_get_token_type)
+    grammar.symbol('EOF')
+    grammar.literal('integer')(int)
+    telemetry = Telemetry(sample_rate=1)
+    parser = Parser(grammar, _tokenizer('+'), telemetry=telemetry)
+    with raises(UnexpectedToken):
+        parser.parse()
+    assert telemetry.outcomes == {'UnexpectedToken': 1}
+
+
+def test_telemetry_threads():
+    grammar = _math_grammar()
+    telemetry = Telemetry(sample_rate=1)
+
+    def parse_many():
+        for _ in range(500):
+            Parser(grammar, _tokenizer('1 + 2'), telemetry=telemetry).parse()
+
+    threads = [threading.Thread(target=parse_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = telemetry.report()
+    assert report['samples'] == 4000
+    assert report['outcomes'] == {'ok': 4000}
+    assert report['tokens'] == {4: 4000}
+
+
+def test_telemetry_max_depth():
+    telemetry = Telemetry(sample_rate=1)
+    parser = Parser(
+        _math_grammar(), _tokenizer('1 + 2 * 3 + 4 + 5'), max_depth=2,
+        telemetry=telemetry
+    )
+    with raises(LimitExceeded):
+        parser.parse()
+    assert telemetry.outcomes == {'LimitExceeded': 1}
+    assert telemetry.depths == {2: 1}
+    # The depth limit applies again after sampling.
+    assert parser.parse() == 12
+    assert telemetry.outcomes == {'LimitExceeded': 1, 'ok': 1}
+
+
+def test_fingerprint():
+    fingerprint = _math_grammar().fingerprint()
+    assert fingerprint == _math_grammar().fingerprint()
+
+    grammar = _math_grammar()
+    grammar.symbol(')')
+    assert grammar.fingerprint() != fingerprint
+
+    grammar = _math_grammar().extend()
+    @grammar.infix('+', 10)
+    def add(token, left, right):
+        return left - right
+    assert grammar.fingerprint() != fingerprint
+
+    grammar = _math_grammar().extend()
+    @grammar.infix('+', 15)
+    def add(token, left, right):
+        return left + right
+    assert grammar.fingerprint() != fingerprint
+
+
+def test_fingerprint_callable_instances():
+    assert (
+        Grammar(functools.partial(_get_token_type)).fingerprint() ==
+        Grammar(functools.partial(_get_token_type)).fingerprint()
+    )
+    assert (
+        Grammar(functools.partial(_get_token_type)).fingerprint() !=
+        Grammar(functools.partial(_handle_unexpected_token)).fingerprint()
+    )
+    try:
+        pickle.loads(pickle.dumps(operator.itemgetter(0), 2))
+    except TypeError:
+        pytest.skip('itemgetter objects cannot be pickled')
+    assert (
+        Grammar(operator.itemgetter(0)).fingerprint() ==
+        Grammar(operator.itemgetter(0)).fingerprint()
+    )
+    assert (
+        Grammar(operator.itemgetter(0)).fingerprint() !=
+        Grammar(operator.itemgetter(1)).fingerprint()
+    )
+
+
+def test_fingerprint_frozen():
+    grammar = _math_grammar().freeze()
+    assert grammar.fingerprint() is grammar.fingerprint()
+
+    # Ternaries and sequences refer to their grammar.
+    fingerprint = _compile_grammar().fingerprint()
+    grammar = _compile_grammar()
+    grammar.freeze()
+    assert grammar.fingerprint() == fingerprint
+    child = _compile_grammar().freeze().extend()
+    parent = _compile_grammar().freeze()
+    parent.fingerprint()
+    assert parent.extend().fingerprint() == child.fingerprint()
+
+
+def test_parse_cache(tmpdir):
+    path = str(tmpdir.join('cache'))
+    calls = []
+    def parse(source):
+        calls.append(source)
+        return Parser(grammar, _tokenizer(source)).parse()
+
+    grammar = _math_grammar()
+    with ParseCache(path, grammar) as cache:
+        assert '1 + 2' not in cache
+        assert cache.get('1 + 2', parse) == 3
+        assert cache.get('1 + 2', parse) == 3
+        assert '1 + 2' in cache
+    assert calls == ['1 + 2']
+
+    with ParseCache(path, _math_grammar()) as cache:
+        assert cache.get('1 + 2', parse) == 3
+    assert calls == ['1 + 2']
+
+    grammar = _math_grammar().extend()
+    grammar.symbol(')')
+    with ParseCache(path, grammar) as cache:
+        assert '1 + 2' not in cache
+        assert cache.get('1 + 2', parse) == 3
+    assert calls == ['1 + 2', '1 + 2']
+
+
+def test_deferred():
+    calls = []
+    def function():
+        calls.append(None)
+        return 1
+    deferred = Deferred(function)
+    assert not deferred.evaluated
+    assert deferred() == 1
+    assert deferred.evaluated
+    assert deferred() == 1
+    assert len(calls) == 1
+
+
+def test_enclosing_lazy():
+    calls = []
+    grammar = _math_grammar()
+    @grammar.literal('-')
+    def count(token):
+        calls.append(token)
+        return 0
+    @grammar.enclosing('(', ')', 100, lazy=True)
+    def parentheses(left_paren, right_paren, body):
+        assert left_paren == '('
+        assert right_paren == ')'
+        assert isinstance(body, Deferred)
+        return body
+    parser = Parser(grammar, _tokenizer('(1 + 2 * 3 + -)'))
+    body = parser.parse()
+    assert parser.token == 'EOF'
+    assert calls == []
+    assert body() == 7
+    assert calls == ['-']
+    assert body() == 7
+    assert calls == ['-']
+
+    parser = Parser(grammar, _tokenizer('((1))'))
+    body = parser.parse()
+    assert parser.token == 'EOF'
+    assert body()() == 1
+
+
+def test_enclosing_lazy_unexpected_token():
+    grammar = _math_grammar()
+    grammar.symbol('-')
+    @grammar.enclosing('(', ')', 100, lazy=True)
+    def parentheses(left_paren, right_paren, body):
+        return body
+    parser = Parser(grammar, _tokenizer('(1 - 2)'))
+    body = parser.parse()
+    with raises(AssertionError):
+        body()
+
+
+def _lazy_ternary_grammar(calls):
+    grammar = _math_grammar()
+    @grammar.literal('-')
+    def count(token):
+        calls.append(token)
+        return 0
+    @grammar.enclosing('(', ')', 100)
+    def parentheses(left_paren, right_paren, body):
+        return body
+    @grammar.ternary('if', 'else', 5, lazy=True)
+    def if_else(if_token, else_token, then, condition, orelse):
+        assert if_token == 'if'
+        assert else_token == 'else'
+        assert isinstance(condition, Deferred)
+        assert isinstance(orelse, Deferred)
+        if condition():
+            return then
+        return orelse()
+    return grammar
+
+
+def test_ternary_lazy():
+    calls = []
+    grammar = _lazy_ternary_grammar(calls)
+    tokens = ['1', 'if', '1', '+', '(', '-', ')', 'else', '2', '*', '-', 'EOF']
+    parser = Parser(grammar, iter(tokens))
+    assert parser.parse() == 1
+    assert parser.token == 'EOF'
+    assert calls == ['-']
+
+    tokens = [
+        '1', 'if', '0', 'else', '2', 'if', '-', 'else', '3', '+', '4', 'EOF'
+    ]
+    parser = Parser(grammar, iter(tokens))
+    assert parser.parse() == 7
+    assert parser.token == 'EOF'
+    assert calls == ['-', '-']
+
+
+def test_ternary_lazy_fallback():
+    calls = []
+    grammar = _lazy_ternary_grammar(calls)
+    @grammar.null_denotation('a')
+    def a(token, parser):
+        calls.append(token)
+        return 2
+    tokens = ['1', 'if', '0', 'else', 'a', '+', '1', 'EOF']
+    parser = Parser(grammar, iter(tokens))
+    assert parser.parse() == 3
+    assert parser.token == 'EOF'
+    assert calls == ['a']
+
+    tokens = ['1', 'if', '1', 'else', 'a', '+', '1', 'EOF']
+    parser = Parser(grammar, iter(tokens))
+    assert parser.parse() == 1
+    assert calls == ['a', 'a']
+
+
+def test_ternary_lazy_second_separator_in_operand():
+    def make_grammar(lazy):
+        grammar = _math_grammar()
+        @grammar.ternary('?', ':', 5, lazy=lazy)
+        def conditional(question, colon, condition, then, orelse):
+            if lazy:
+                return condition, then(), orelse()
+            return condition, then, orelse
+        @grammar.null_denotation('case')
+        def case(token, parser):
+            value = parser.parse()
+            parser.advance(':')
+            return ('case', value, parser.parse(10))
+        return grammar
+    tokens = ['1', '?', 'case', '2', ':', '3', ':', '4', 'EOF']
+    for lazy in [False, True]:
+        parser = Parser(make_grammar(lazy), iter(tokens))
+        assert parser.parse() == (1, ('case', 2, 3), 4)
+        assert parser.token == 'EOF'
+
+    tokens = ['1', '?', '2', '?', 'case', '3', ':', '4', ':', '5', ':', '6',
+              'EOF']
+    for lazy in [False, True]:
+        parser = Parser(make_grammar(lazy), iter(tokens))
+        assert parser.parse() == (1, (2, ('case', 3, 4), 5), 6)
+
+
+def _nary_grammar(calls):
+    grammar = Grammar(_get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    @grammar.literal('integer')
+    def integer(token):
+        return int(token)
+    @grammar.infix_nary('+', 10)
+    def add(tokens, operands):
+        calls.append((tokens, operands))
+        return ('+', operands)
+    @grammar.infix_nary('-', 10)
+    def sub(tokens, operands):
+        calls.append((tokens, operands))
+        return ('-', operands)
+    @grammar.infix('*', 20)
+    def mul(token, left, right):
+        return ('*', left, right)
+    return grammar
+
+
+def test_infix_nary():
+    calls = []
+    grammar = _nary_grammar(calls)
+    parser = Parser(grammar, _tokenizer('1 + 2 * 3 + 4 - 5 + 6'))
+    assert parser.parse() == (
+        '+', [('-', [('+', [1, ('*', 2, 3), 4]), 5]), 6]
+    )
+    assert calls[0] == (['+', '+'], [1, ('*', 2, 3), 4])
+    assert len(calls) == 3
+
+
+def test_parse_parallel_infix_nary():
+    calls = []
+    grammar = Grammar(_get_token_type, _handle_unexpected_token)
+    grammar.symbol('EOF')
+    grammar.literal('integer')(int)
+    grammar.infix('*', 20)(lambda token, left, right: left * right)
+    @grammar.infix_nary('+', 10)
+    def add(tokens, operands):
+        calls.append(tokens)
+        return sum(operands)
+    tokens = list(_tokenizer(' + '.join('{0} * 2'.format(i) for i in range(50))))
+    expected = Parser(grammar, iter(tokens)).parse()
+    del calls[:]
+    assert parse_parallel(grammar, tokens, 3) == expected
+    # The workers combine the runs, only the results of the runs are
+    # combined in this process.
+    assert calls == [['+', '+']]
+
+    calls = []
+    grammar = _nary_grammar(calls)
+    tokens = list(_tokenizer('1 + 2 - 3 + 4'))
+    expected = Parser(grammar, iter(tokens)).parse()
+    assert parse_parallel(grammar, tokens, 2) == expected
+
+
+def _sequence_grammar(lazy=False):
+    grammar = _math_grammar()
+    @grammar.sequence('[', ',', ']', lazy=lazy)
+    def list_literal(begin, end, elements):
+        assert begin == '['
+        elements = list(elements)
+        assert (end() if lazy else end) == ']'
+        return elements
+    return grammar
+
+
+def test_sequence():
+    grammar = _sequence_grammar()
+    tokens = ['[', '1', ',', '2', '+', '3', ',', '[', ']', ']', 'EOF']
+    parser = Parser(grammar, iter(tokens))
+    assert parser.parse() == [1, 5, []]
+    assert parser.token == 'EOF'
+
+
+def test_sequence_unexpected_token():
+    for lazy in [False, True]:
+        grammar = _sequence_grammar(lazy)
+        parser = Parser(grammar, iter(['[', '1', '2', ']', 'EOF']))
+        with raises(AssertionError):
+            parser.parse()
+
+
+def test_sequence_large():
+    grammar = _sequence_grammar()
+    tokens = ['[']
+    for i in range(10000):
+        tokens.extend([str(i), ','])
+    tokens[-1:] = [']', 'EOF']
+    parser = Parser(grammar, iter(tokens), max_depth=3)
+    assert parser.parse() == list(range(10000))
+
+
+def test_sequence_lazy():
+    grammar = _sequence_grammar(lazy=True)
+    tokens = ['[', '1', ',', '2', '+', '3', ',', '[', ']', ']', 'EOF']
+    parser = Parser(grammar, iter(tokens))
+    assert parser.parse() == [1, 5, []]
+    assert parser.token == 'EOF'
+
+
+def test_sequence_lazy_partially_consumed():
+    grammar = _math_grammar()
+    @grammar.sequence('[', ',', ']', lazy=True)
+    def first(begin, end, elements):
+        return next(elements)
+    @grammar.null_denotation('a')
+    def a(token, parser):
+        assert False, 'parsed element that was not requested'
+    tokens = ['[', '1', ',', 'a', ',', '3', ']', '+', '1', 'EOF']
+    parser = Parser(grammar, iter(tokens))
+    assert parser.parse() == 2
+    assert parser.token == 'EOF'
+
+
+def test_sequence_lazy_streaming():
+    grammar = _math_grammar()
+    consumed = []
+    def generate_tokens():
+        yield '['
+        for i in range(1000):
+            consumed.append(i)
+            yield str(i)
+            yield ',' if i < 999 else ']'
+        yield 'EOF'
+    @grammar.sequence('[', ',', ']', lazy=True)
+    def total(begin, end, elements):
+        result = 0
+        for element in elements:
+            # Only the tokens up to the next element have been read.
+            assert len(consumed) <= element + 2
+            result += element
+        assert end() == ']'
+        return result
+    assert Parser(grammar, generate_tokens()).parse() == sum(range(1000))
+
+
+def test_sequence_lazy_end():
+    grammar = _math_grammar()
+    @grammar.sequence('[', ',', ']', lazy=True)
+    def skip(begin, end, elements):
+        assert next(elements) == 1
+        assert end() == ']'
+        assert list(elements) == []
+        return 0
+    tokens = ['[', '1', ',', '[', '2', ']', ',', '3', ']', '+', '1', 'EOF']
+    parser = Parser(grammar, iter(tokens))
+    assert parser.parse() == 1
+    assert parser.token == 'EOF'
+
+
+def _compile_grammar():
+    grammar = _math_grammar()
+    grammar.prefix('-', 100)(None)
+    grammar.infix_r('**', 30)(None)
+    grammar.postfix('/', 40)(None)
+    grammar.enclosing('(', ')', 0)(None)
+    grammar.sequence('[', ',', ']')(None)
+    grammar.infix_nary('&', 5)(None)
+    grammar.ternary('if', 'else', 1)(None)
+    return grammar
+
+
+_FUNCTIONS = {
+    ('infix', '+'): operator.add,
+    ('infix', '*'): operator.mul,
+    ('prefix', '-'): operator.neg,
+    ('infix_r', '**'): operator.pow,
+    ('postfix', '/'): lambda operand: operand // 2,
+    ('sequence', '['): lambda *elements: list(elements),
+    ('infix_nary', '&'): lambda *operands: operands,
+    ('ternary', 'if'): lambda then, condition, orelse: (
+        then if condition else orelse
+    ),
+}
+
+
+def test_compile():
+    grammar = _compile_grammar()
+    parser = Parser(grammar, _tokenizer('1 + 2 * -3'))
+    program = parser.compile()
+    assert isinstance(program, Program)
+    assert parser.token == 'EOF'
+    assert list(program.opcodes) == [0, 0, 0, 1, 2, 3]
+    assert list(program.arguments) == [0, 1, 2, 1, 2, 2]
+    assert program.constants == [1, 2, 3]
+    assert program.operations == [
+        ('prefix', '-'), ('infix', '*'), ('infix', '+')
+    ]
+    assert len(program) == 6
+    assert program.run(_FUNCTIONS) == -5
+
+
+def test_compile_run():
+    grammar = _compile_grammar()
+    tokens = [
+        '[', '(', '1', '+', '2', ')', '*', '2', '**', '3', '**', '2', '/',
+        ',', '1', 'if', '0', 'else', '2', ',', '1', '&', '2', '&', '3', ']',
+        'EOF'
+    ]
+    program = Parser(grammar, iter(tokens)).compile()
+    assert program.run(_FUNCTIONS) == [3 * 2 ** 3 ** (2 // 2), 2, (1, 2, 3)]
+    tokens = ['[', ']', 'EOF']
+    assert Parser(grammar, iter(tokens)).compile().run(_FUNCTIONS) == []
+
+
+def test_compile_unsupported():
+    grammar = _compile_grammar()
+    @grammar.null_denotation('a')
+    def a(token, parser):
+        return token
+    with raises(ValueError):
+        Parser(grammar, iter(['1', '+', 'a', 'EOF'])).compile()
+    with raises(AssertionError):
+        Parser(grammar, iter(['1', '+', ')', 'EOF'])).compile()
+
+
+def test_failed_redefinition_keeps_shape():
+    grammar = _compile_grammar()
+    with raises(RuntimeError):
+        grammar.infix('+', 10)(operator.sub)
+    program = Parser(grammar, _tokenizer('1 + 2')).compile()
+    assert program.run(_FUNCTIONS) == 3
+
+
+def test_compile_limits():
+    grammar = _compile_grammar()
+    assert Parser(grammar, _tokenizer('((1))'), max_depth=3).compile()
+    with raises(LimitExceeded) as exc_info:
+        Parser(grammar, _tokenizer('((((1))))'), max_depth=3).compile()
+    assert exc_info.value.limit == 'max_depth'
+    with raises(LimitExceeded) as exc_info:
+        Parser(grammar, _tokenizer('1 + 2 + 3'), max_tokens=4).compile()
+    assert exc_info.value.limit == 'max_tokens'
+    source = ' + '.join(['1'] * 1000)
+    with raises(LimitExceeded) as exc_info:
+        Parser(grammar, _tokenizer(source), timeout=0).compile()
+    assert exc_info.value.limit == 'timeout'
+    parser = Parser(grammar, _tokenizer('1 + 2'), max_depth=3)
+    parser.compile()
+    assert parser._depth == 0
+
+
+def test_program_pickle():
+    grammar = _compile_grammar()
+    program = Parser(grammar, _tokenizer('1 + 2 * 3 + 4')).compile()
+    unpickled = pickle.loads(pickle.dumps(program, 2))
+    assert unpickled == program
+    assert unpickled.run(_FUNCTIONS) == 11
+    unpickled._emit('infix', '+', 2)
+    assert unpickled.opcodes[-1] == unpickled.opcodes[-2]
+
+
+_Pair = namedtuple('_Pair', ['first', 'second'])
+
+
+def test_node_codec():
+    codec = NodeCodec([_Literal, _Operation, _Pair])
+    source = ' + '.join('{0} * ({0} ** 2)'.format(i % 10) for i in range(50))
+    tree = Parser(_node_grammar(), _tokenizer(source)).parse()
+    encoded = codec.encode(tree)
+    assert isinstance(encoded, bytes)
+    assert len(encoded) < len(pickle.dumps(tree, pickle.HIGHEST_PROTOCOL))
+    assert codec.decode(encoded) == tree
+    assert codec.decode(bytearray(encoded)) == tree
+
+    tree = _Operation(
+        u'\xe9', _Pair(None, (True, False, -5, 1 << 20)), ((), _Literal('1'))
+    )
+    assert codec.decode(codec.encode(tree)) == tree
+    assert codec.decode(codec.encode(u'\xe9')) == u'\xe9'
+    assert codec.decode(codec.encode(None)) is None
+
+
+def test_node_codec_view():
+    codec = NodeCodec([_Literal, _Operation, _Pair])
+    tree = _Operation('+', _Literal('1'), _Pair(_Literal('2'), 3))
+    view = codec.view(codec.encode(tree))
+    assert isinstance(view, NodeView)
+    assert view.type is _Operation
+    assert len(view) == 3
+    assert view[0] == view.operator == '+'
+    assert view.left.type is _Literal
+    assert view.left.token == '1'
+    assert view[-1].second == 3
+    assert view.right.first.materialize() == _Literal('2')
+    assert view.right.materialize() == _Pair(_Literal('2'), 3)
+    assert view.materialize() == tree
+    with raises(IndexError):
+        view[3]
+    with raises(AttributeError):
+        view.first
+
+
+def test_node_codec_values():
+    codec = NodeCodec([_Literal, _Pair])
+    values = [
+        'native', b'\xff\x00', u'\xe9', 1.5, -0.0, 0.0, float('inf'),
+        1 << 29, -(1 << 29) - 1, 1 << 100, -(1 << 100), (1 << 29) - 1
+    ]
+    tree = _Pair(tuple(_Literal(value) for value in values), 1.5)
+    decoded = codec.decode(codec.encode(tree))
+    assert decoded == tree
+    for literal, value in zip(decoded.first, values):
+        assert literal.token.__class__ is value.__class__
+    assert str(decoded.first[4].token) == '-0.0'
+    view = codec.view(codec.encode(tree))
+    assert [literal.token for literal in view.first.materialize()] == values
+    assert view.first[1].token == b'\xff\x00'
+    assert view.second == 1.5
+    assert codec.decode(codec.encode(1 << 40)) == 1 << 40
+
+
+def test_node_codec_inheritance():
+    class Annotated(_Operation):
+        __slots__ = ('annotation',)
+    codec = NodeCodec([Annotated])
+    tree = Annotated('+', 1, 2, 'int')
+    assert codec.decode(codec.encode(tree)) == tree
+    view = codec.view(codec.encode(tree))
+    assert (view.operator, view.annotation) == ('+', 'int')
+
+
+def test_node_codec_unsupported():
+    codec = NodeCodec([_Literal])
+    for value in [_Operation('+', 1, 2), _Pair(1, 2), object(), [1]]:
+        with raises(ValueError):
+            codec.encode(_Literal(value))
+
+
+def test_node_codec_deep():
+    codec = NodeCodec([_Literal, _Operation])
+    tree = _Literal('0')
+    for i in range(10000):
+        tree = _Operation('**', _Literal(str(i)), tree)
+    decoded = codec.decode(codec.encode(tree))
+    for i in reversed(range(10000)):
+        assert decoded.left == _Literal(str(i))
+        decoded = decoded.right
+    assert decoded == _Literal('0')